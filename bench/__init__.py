@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+"""
+性能基准工具：合成 Label Studio 任务与图像、本地桩服务器、分阶段计时与峰值内存报告。
+
+运行：
+  python -m bench                                  # 默认规模
+  python -m bench --annotations 100,5000 --sizes 2000x1500,12000x9000 --repeat 5
+  python -m bench > bench_output.txt
+
+不需要真实的 Label Studio，也不需要配置 label_studio_api_token。
+"""
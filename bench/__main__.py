@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+分阶段基准：对每个 (图像尺寸, 标注数量) 组合重复运行渲染流水线，
+报告 fetch / decode / resize / encode / embed / overlay / save 各阶段耗时与峰值内存增量，
+以及生产路径（可直通 JPEG）和经由 Flask /download 的端到端耗时。
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from io import BytesIO
+
+from bench.stub_server import StubLabelStudio
+from bench.synth import make_image, make_project, make_task, parse_size
+
+
+class PeakMemory:
+    """
+    测量代码块执行期间的峰值内存增量（MB）。
+    Linux 下后台线程采样 /proc/self/statm 的 RSS（包含 PIL/reportlab 的 C 层分配），
+    其他平台退化为 tracemalloc（只统计 Python 堆）。
+    """
+
+    def __init__(self, interval: float = 0.002):
+        self.interval = interval
+        self.peak_mb = 0.0
+        self._use_proc = os.path.exists('/proc/self/statm')
+        self._page_size = os.sysconf('SC_PAGE_SIZE') if self._use_proc else 0
+
+    def _rss(self) -> int:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * self._page_size
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self._peak = max(self._peak, self._rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        if self._use_proc:
+            self._stop = threading.Event()
+            self._start = self._peak = self._rss()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        else:
+            tracemalloc.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._use_proc:
+            self._stop.set()
+            self._thread.join()
+            self._peak = max(self._peak, self._rss())
+            self.peak_mb = (self._peak - self._start) / 1e6
+        else:
+            self.peak_mb = tracemalloc.get_traced_memory()[1] / 1e6
+            tracemalloc.stop()
+        return False
+
+
+class StageRecorder:
+    """收集每个阶段多次运行的耗时（秒）与峰值内存增量（MB）。"""
+
+    def __init__(self):
+        self.samples = {}
+
+    def run(self, name: str, fn, *args, **kwargs):
+        with PeakMemory() as mem:
+            start = time.perf_counter()
+            result = fn(*args, **kwargs)
+            elapsed = time.perf_counter() - start
+        self.samples.setdefault(name, []).append((elapsed, mem.peak_mb))
+        return result
+
+    def report(self, title: str, out=sys.stdout):
+        print(f"\n== {title}", file=out)
+        print(f"{'stage':<12}{'median ms':>12}{'min ms':>12}{'peak ΔMB':>12}", file=out)
+        for name, samples in self.samples.items():
+            times = [t * 1000 for t, _ in samples]
+            peak = max(m for _, m in samples)
+            print(f"{name:<12}{statistics.median(times):>12.1f}{min(times):>12.1f}{peak:>12.1f}", file=out)
+
+
+def run_stages(main, rec: StageRecorder, task_id: int, ocr: str, max_dimension):
+    """
+    按阶段拆开执行一次解码路径（强制解码、缩放、重新编码），每个阶段单独计时。
+    """
+    from reportlab.pdfgen import canvas
+
+    main._project_cache.clear()
+
+    def fetch():
+        meta = main.get_project_meta(1)
+        td = main.fetch_task(task_id)
+        resp = main.ls_get(ocr)   # 绕过原图磁盘缓存，测量真实传输
+        resp.raise_for_status()
+        return meta, td, resp.content
+
+    meta, td, data = rec.run('fetch', fetch)
+    annotations = rec.run('load', main.load_annotations, td)
+    image = rec.run('decode', main.decode_image, data, max_dimension)
+    image = rec.run('resize', main.resize_image, image, max_dimension)
+    image_buffer = rec.run('encode', main.encode_jpeg, image)
+    width, height = image.size
+    del image
+
+    output = BytesIO()
+    pdf_canvas = canvas.Canvas(output, pageCompression=True)
+    pdf_canvas.setPageSize((width, height))
+    rec.run('embed', pdf_canvas.drawImage, main.JPEGPassthroughReader(image_buffer), 0, 0, width=width, height=height)
+    rec.run('overlay', main.draw_annotations, pdf_canvas, annotations, meta.palette, width, height)
+
+    def save():
+        pdf_canvas.showPage()
+        pdf_canvas.save()
+
+    rec.run('save', save)
+    return data, annotations, meta
+
+
+def main_cli(argv=None):
+    ap = argparse.ArgumentParser(prog='python -m bench', description=__doc__)
+    ap.add_argument('--annotations', default='100,1000,5000', help='逗号分隔的标注数量')
+    ap.add_argument('--sizes', default='2000x1500,6000x4500,12000x9000', help='逗号分隔的图像尺寸 WxH')
+    ap.add_argument('--repeat', type=int, default=3, help='每个组合重复次数')
+    ap.add_argument('--quality', default='standard', help='preview | standard | full')
+    ap.add_argument('--latency', type=float, default=0.0, help='桩服务器每个请求的注入延迟（秒）')
+    ap.add_argument('--progressive', action='store_true', help='生成渐进式 JPEG（无法直通，强制走解码路径）')
+    ap.add_argument('--polygons', type=float, default=0.0, help='多边形标注所占比例（0–1）')
+    ap.add_argument('--seed', type=int, default=0)
+    args = ap.parse_args(argv)
+
+    counts = [int(n) for n in args.annotations.split(',')]
+    sizes = [parse_size(s) for s in args.sizes.split(',')]
+
+    print(f"生成合成数据：sizes={args.sizes} annotations={args.annotations}", file=sys.stderr)
+    images, tasks, combos = {}, {}, []
+    task_id = 0
+    for w, h in sizes:
+        path = f"/data/upload/1/bench_{w}x{h}.jpg"
+        images[path] = make_image(w, h, seed=args.seed, progressive=args.progressive)
+        for n in counts:
+            task_id += 1
+            tasks[task_id] = make_task(task_id, n, ocr=path, seed=args.seed, polygon_ratio=args.polygons)
+            combos.append((task_id, (w, h), n, path))
+
+    stub = StubLabelStudio(make_project(), tasks, images, latency=args.latency).start()
+    cache_dir = tempfile.mkdtemp(prefix='label-to-pdf-bench-')
+    os.environ['label_studio_host'] = stub.url
+    os.environ.setdefault('label_studio_api_token', 'bench')
+    os.environ['cache_dir'] = cache_dir
+
+    import main
+    max_dimension = main.QUALITY_PROFILES[args.quality]
+    client = main.app.test_client()
+
+    try:
+        for task_id, (w, h), n, path in combos:
+            rec = StageRecorder()
+            for _ in range(args.repeat):
+                data, annotations, meta = run_stages(main, rec, task_id, path, max_dimension)
+
+                # 生产路径：原始字节交给 annotate_image_to_pdf（满足条件时直通 JPEG）
+                rec.run('render', main.annotate_image_to_pdf, data, annotations, BytesIO(),
+                        meta.palette, 'bench', max_dimension)
+
+                # 端到端：经由 Flask 路由，每次清空 PDF / 原图缓存
+                main._pdf_cache.clear()
+                main._image_cache.clear()
+                resp = rec.run('http', client.get, f"/download?project=1&task={task_id}&quality={args.quality}")
+                assert resp.status_code == 200, resp.data[:200]
+            passthrough = main.can_passthrough(main.Image.open(BytesIO(images[path])), max_dimension)
+            rec.report(f"{w}x{h} image ({len(images[path]) / 1e6:.1f} MB), {n} annotations, "
+                       f"quality={args.quality}, passthrough={'yes' if passthrough else 'no'}")
+    finally:
+        stub.stop()
+
+
+if __name__ == '__main__':
+    main_cli()
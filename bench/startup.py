@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+冷启动基准：每轮启动一个全新的 Python 进程，测量
+  import   导入 main 的耗时
+  first    导入后直接渲染第一张 PDF 的耗时（含字体解析等首次开销）
+  warm_up  调用 main.warm_up() 的耗时
+  warmed   预热之后再渲染第一张 PDF 的耗时（即 gunicorn 预加载后 worker 的首个请求）
+
+  python -m bench.startup --repeat 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+_CHILD = r'''
+import json, sys, time
+from io import BytesIO
+sys.path.insert(0, {root!r})
+from bench.synth import make_image, make_task
+
+image, task = make_image(1600, 1200), make_task(1, {annotations})
+start = time.perf_counter()
+import main
+result = {{'import': time.perf_counter() - start}}
+if {warm}:
+    result['warm_up'] = main.warm_up()
+start = time.perf_counter()
+main.annotate_image_to_pdf(image, main.load_annotations(task), BytesIO(), {{'Length': 'red'}}, 'bench')
+result['warmed' if {warm} else 'first'] = time.perf_counter() - start
+print(json.dumps(result))
+'''
+
+
+def run_child(root: str, annotations: int, warm: bool, env: dict) -> dict:
+    code = _CHILD.format(root=root, annotations=annotations, warm=warm)
+    out = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main_cli(argv=None):
+    ap = argparse.ArgumentParser(prog='python -m bench.startup', description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--repeat', type=int, default=10, help='每种情形启动的进程数')
+    ap.add_argument('--annotations', type=int, default=100, help='首张 PDF 的标注数量')
+    args = ap.parse_args(argv)
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, cache_dir=tempfile.mkdtemp(prefix='label-to-pdf-startup-'))
+    samples = {}
+    for warm in (False, True):
+        for _ in range(args.repeat):
+            for phase, seconds in run_child(root, args.annotations, warm, env).items():
+                samples.setdefault(phase, []).append(seconds * 1000)
+
+    print(f"{'phase':<10}{'median ms':>12}{'min ms':>12}")
+    for phase in ('import', 'first', 'warm_up', 'warmed'):
+        times = samples.get(phase)
+        if times:
+            print(f"{phase:<10}{statistics.median(times):>12.1f}{min(times):>12.1f}")
+
+
+if __name__ == '__main__':
+    main_cli()
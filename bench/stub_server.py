@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+本地 Label Studio 桩服务器：提供 /api/projects/<id>、/api/tasks（分页）、/api/tasks/<id> 和 OCR 图像，
+可注入固定延迟，用于在不依赖真实 Label Studio 的情况下测量拉取阶段。
+"""
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class StubLabelStudio:
+    """
+    用法：
+        stub = StubLabelStudio(project, tasks, images, latency=0.02).start()
+        os.environ['label_studio_host'] = stub.url
+        ...
+        stub.stop()
+    project 为项目 JSON，tasks 为 {task_id: task_json}，images 为 {路径: 图像字节}。
+    """
+
+    def __init__(self, project: dict, tasks: dict, images: dict, latency: float = 0.0):
+        self.project = project
+        self.tasks = tasks
+        self.images = images
+        self.latency = latency
+        self.requests = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self, host: str = '127.0.0.1', port: int = 0):
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='stub-label-studio', daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def count(self, path: str) -> int:
+        with self._lock:
+            return self.requests.get(path, 0)
+
+    def _record(self, path: str):
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, body: bytes = b'', content_type: str = 'application/json', headers=None):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _send_json(self, obj, headers=None):
+                self._send(200, json.dumps(obj).encode('utf-8'), headers=headers)
+
+            def do_GET(self):
+                if stub.latency:
+                    time.sleep(stub.latency)
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                stub._record(url.path)
+
+                if url.path.startswith('/api/projects/'):
+                    body = json.dumps(stub.project).encode('utf-8')
+                    etag = '"%s"' % hashlib.sha1(body).hexdigest()
+                    if self.headers.get('If-None-Match') == etag:
+                        return self._send(304, headers={'ETag': etag})
+                    return self._send(200, body, headers={'ETag': etag})
+
+                if url.path.rstrip('/') == '/api/tasks':
+                    page = int(query.get('page', ['1'])[0])
+                    page_size = int(query.get('page_size', ['100'])[0])
+                    ids = sorted(stub.tasks)
+                    chunk = ids[(page - 1) * page_size:page * page_size]
+                    if not chunk and page > 1:
+                        return self._send(404, b'{"detail": "Invalid page."}')
+                    return self._send_json({
+                        'total': len(ids),
+                        'tasks': [{'id': i, 'updated_at': stub.tasks[i].get('updated_at')} for i in chunk],
+                    })
+
+                if url.path.startswith('/api/tasks/'):
+                    try:
+                        task = stub.tasks[int(url.path.rstrip('/').rsplit('/', 1)[1])]
+                    except (KeyError, ValueError):
+                        return self._send(404, b'{"detail": "Not found."}')
+                    return self._send_json(task)
+
+                if url.path in stub.images:
+                    data = stub.images[url.path]
+                    content_type = 'image/png' if data[:4] == b'\x89PNG' else 'image/jpeg'
+                    return self._send(200, data, content_type)
+
+                self._send(404, b'{"detail": "Not found."}')
+
+        return Handler
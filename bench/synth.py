@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+合成测试数据：与 load_annotations 读取格式一致的 Task JSON，以及不同分辨率的 OCR 图像。
+所有生成函数都接受 seed，结果可重复。
+"""
+import random
+from io import BytesIO
+
+from PIL import Image
+
+LENGTH_SAMPLES = ["155' 5 1/4\"", "50", "159 0 12", "5 1/2\"", "12' 3\"", "1/2\"", "88 7 34"]
+BEARING_SAMPLES = ["45 30 15", "90", "179 59 59", "270 0 30", "12 5"]
+OTHER_SAMPLES = ["Lot 12", "DP 123456", "Road Reserve", "Easement A"]
+
+
+def make_task(
+    task_id: int = 1,
+    n_annotations: int = 100,
+    ocr: str = '/data/upload/1/bench.jpg',
+    seed: int = 0,
+    rotation_ratio: float = 0.2,
+    thin_ratio: float = 0.3,
+    polygon_ratio: float = 0.0,
+    project_id: int = 1,
+    updated_at: str = '2025-01-02T03:04:05.123456Z'
+) -> dict:
+    """
+    生成一个任务：n_annotations 个矩形，标签按 Length / Bearing / 其他 轮换，
+    每个 Length 与紧随其后的 Bearing 之间建立关系；
+    rotation_ratio 比例的框带旋转，thin_ratio 比例的框高度不足 1 像素（走小字号分支），
+    polygon_ratio 比例的标注改为 6 个顶点的多边形（取值在框内）。
+    """
+    rng = random.Random(seed)
+    result = []
+    for i in range(n_annotations):
+        eid = f"bench{i}"
+        label = ('Length', 'Bearing', 'Lot')[i % 3]
+        value = {
+            'x': rng.uniform(0, 90),
+            'y': rng.uniform(2, 95),
+            'width': rng.uniform(1, 8),
+            'height': 0.01 if rng.random() < thin_ratio else rng.uniform(0.5, 3),
+            'rotation': rng.choice((30, 90, 315)) if rng.random() < rotation_ratio else 0,
+        }
+        if label == 'Length':
+            text = rng.choice(LENGTH_SAMPLES)
+        elif label == 'Bearing':
+            text = rng.choice(BEARING_SAMPLES)
+        else:
+            text = rng.choice(OTHER_SAMPLES)
+        if polygon_ratio and rng.random() < polygon_ratio:
+            points = [[value['x'] + rng.uniform(0, value['width']), value['y'] + rng.uniform(0, value['height'])]
+                      for _ in range(6)]
+            value = {'points': points, 'closed': True}
+            result.append({'id': eid, 'type': 'polygon', 'from_name': 'poly', 'to_name': 'image', 'value': value})
+        else:
+            result.append({'id': eid, 'type': 'rectangle', 'from_name': 'bbox', 'to_name': 'image', 'value': value})
+        result.append({'id': eid, 'type': 'labels', 'from_name': 'label', 'to_name': 'image',
+                       'value': dict(value, labels=[label])})
+        result.append({'id': eid, 'type': 'textarea', 'from_name': 'transcription', 'to_name': 'image',
+                       'value': dict(value, text=[text])})
+    for i in range(0, n_annotations - 1, 3):
+        result.append({'type': 'relation', 'from_id': f"bench{i}", 'to_id': f"bench{i + 1}",
+                       'direction': 'right', 'labels': []})
+    return {
+        'id': task_id,
+        'project': project_id,
+        'updated_at': updated_at,
+        'data': {'ocr': ocr},
+        'annotations': [{'id': task_id * 10, 'completed_by': 1, 'updated_at': updated_at, 'result': result}],
+    }
+
+
+def make_project(project_id: int = 1, title: str = 'Bench Project') -> dict:
+    """
+    生成项目 JSON，只包含渲染用到的 title 与 parsed_label_config。
+    """
+    return {
+        'id': project_id,
+        'title': title,
+        'parsed_label_config': {'label': {'labels_attrs': {
+            'Length': {'value': 'Length', 'background': '#ff0000'},
+            'Bearing': {'value': 'Bearing', 'background': '#0000ff'},
+            'Lot': {'value': 'Lot', 'background': '#00aa00'},
+        }}},
+    }
+
+
+def make_image(width: int, height: int, fmt: str = 'JPEG', seed: int = 0, **save_kwargs) -> bytes:
+    """
+    生成带噪声纹理的扫描件替身（纯色图压缩率过高，不能代表真实 JPEG 大小与解码成本）。
+    """
+    rng = random.Random(seed)
+    tile = Image.effect_noise((512, 512), 40 + rng.random() * 10)
+    noise = Image.new('L', (width, height))
+    for x in range(0, width, 512):
+        for y in range(0, height, 512):
+            noise.paste(tile, (x, y))
+    gradient = Image.linear_gradient('L').resize((width, height), Image.BILINEAR)
+    image = Image.merge('RGB', (noise, gradient, Image.eval(noise, lambda v: 255 - v)))
+    if fmt == 'JPEG':
+        save_kwargs.setdefault('quality', 90)
+    buf = BytesIO()
+    image.save(buf, format=fmt, **save_kwargs)
+    return buf.getvalue()
+
+
+def parse_size(text: str) -> tuple:
+    """'6000x4500' -> (6000, 4500)"""
+    w, h = text.lower().split('x')
+    return int(w), int(h)
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+"""
+gunicorn 配置：在 master 中预加载应用并预热一次，worker fork 后直接继承已导入的模块、
+已解析的字体与 PIL / reportlab 的初始化结果，重启或扩容后的首个请求不再承担这些开销。
+"""
+
+preload_app = True
+
+
+def when_ready(server):
+    # when_ready 在 master 中、首次 fork worker 之前执行
+    import main
+    seconds = main.warm_up()
+    server.log.info("预热完成：导入 %.3fs，预热渲染 %.3fs", main.STARTUP_SECONDS.get('import', 0), seconds)
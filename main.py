@@ -9,14 +9,37 @@
 
 所有时间为澳大利亚悉尼时间（AEST/AEDT）。
 """
+import contextvars
+import fcntl
+import hashlib
+import io
+import itertools
+import json
+import math
 import os
 import re
-from decimal import Decimal, getcontext
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from decimal import Decimal, localcontext
+from functools import lru_cache
 from io import BytesIO
 
+# 启动耗时从这里开始计（标准库之后的第三方导入、字体与缓存初始化都计入），见 STARTUP_SECONDS
+_IMPORT_STARTED = time.perf_counter()
+
 import requests
-from flask import Flask, send_file, jsonify, request
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, Response, g, send_file, jsonify, request
 from PIL import Image
+from reportlab import rl_config
 from reportlab.pdfgen import canvas
 from reportlab.lib.utils import ImageReader
 from reportlab.lib.colors import Color
@@ -30,24 +53,278 @@ from dateutil import parser, tz
 # -------------------------------
 app = Flask(__name__)
 
-# 环境变量配置
+# 环境变量配置（token 在第一次请求 Label Studio 时才检查，离线渲染无需配置）
 LABEL_STUDIO_HOST  = os.getenv('label_studio_host')
 LABEL_STUDIO_TOKEN = os.getenv('label_studio_api_token')
-if not LABEL_STUDIO_TOKEN:
-    raise RuntimeError("请先配置环境变量：label_studio_api_token")
 
-# 注册自定义字体（支持中文）
+# PDF 流直接写二进制，不做 ASCII85 编码（嵌入的 JPEG 不会因此膨胀 25%）
+rl_config.useA85 = 0
+
+# 自定义字体（支持中文），首次绘制时由 ensure_fonts() 注册
 BASE_DIR = os.path.dirname(__file__)
 FONT_PATH = os.path.join(BASE_DIR, 'DejaVuSans.ttf')
-pdfmetrics.registerFont(TTFont('DejaVuSans', FONT_PATH))
+_fonts_ready = False
+_fonts_lock = threading.Lock()
+# canvas.save() 时按文档做字体子集，TTFontFace 内部共用一个读取位置，多线程同时保存会读错字形表
+_font_subset_lock = threading.Lock()
+
+
+def ensure_fonts():
+    """
+    解析并注册 TTF 字体，每个进程只做一次。
+    gunicorn 预加载时由 warm_up() 在 master 中完成，fork 出的 worker 直接继承。
+    """
+    global _fonts_ready
+    if _fonts_ready:
+        return
+    with _fonts_lock:
+        if not _fonts_ready:
+            pdfmetrics.registerFont(TTFont('DejaVuSans', FONT_PATH))
+            _fonts_ready = True
+
 
 # 使用悉尼时区
 SYDNEY_TZ = tz.gettz('Australia/Sydney')
 
+# 渲染器版本：绘制逻辑改变输出时递增，使已缓存的 PDF 失效
+RENDERER_VERSION = '6'
+
+# 缓存根目录（磁盘缓存、导出任务目录与渲染准入状态都在其下）
+CACHE_DIR = os.getenv('cache_dir', os.path.join(tempfile.gettempdir(), 'label-to-pdf'))
+
+# 输出图像长边上限（standard 档），超过则缩小，防止太大导致PDF异常
+MAX_DIMENSION = int(os.getenv('max_dimension', '6000'))
+# 单次解码允许的最大像素数（约等于内存预算 / 3 字节），超过则降采样或拒绝
+MAX_DECODE_PIXELS = int(os.getenv('max_decode_pixels', str(100_000_000)))
+# 生成中的 PDF 在内存中最多保留的字节数，超过后转存临时文件
+SPOOL_MAX_MEMORY = int(os.getenv('spool_max_memory', str(8 * 1024 ** 2)))
+# 文件复制与响应流式发送的分块大小
+STREAM_CHUNK_SIZE = 256 * 1024
+# 输出质量档位 -> 长边上限，None 表示保留原始分辨率（仍受 MAX_DECODE_PIXELS 限制）
+QUALITY_PROFILES = {
+    'preview': int(os.getenv('preview_max_dimension', '2000')),
+    'standard': MAX_DIMENSION,
+    'full': None,
+}
+DEFAULT_QUALITY = os.getenv('default_quality', 'standard')
+
+# 像素上限由 prepare_page_image 按文件头检查，不再依赖 PIL 的解压炸弹告警
+Image.MAX_IMAGE_PIXELS = None
+
+
+class ImageTooLargeError(ValueError):
+    """源图像在当前像素预算下无法解码。"""
+
+
+class RenderRejectedError(RuntimeError):
+    """渲染资源已满且排队超时，retry_after 为建议的重试间隔（秒）。"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+# -------------------------------
+# 性能指标
+# -------------------------------
+
+# 允许通过 ?profile=1 对单个请求启用 cProfile（仅调试环境开启）
+DEBUG_PROFILE = os.getenv('debug_profile', '').lower() in ('1', 'true', 'yes')
+
+# 秒级直方图分桶
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{n}="{str(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """Prometheus 计数器（按标签值分组），进程内累计。"""
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name, self.help, self.labelnames = name, help_text, labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    """Prometheus 直方图（按标签值分组），进程内累计。"""
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.help, self.labelnames, self.buckets = name, help_text, labelnames, buckets
+        self._values = {}   # labels -> [各分桶计数..., sum, count]
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value: float, *labels):
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, series in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, series):
+                    le = _format_labels(self.labelnames, labels, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{le} {count}")
+                le = _format_labels(self.labelnames, labels, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{le} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {series[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {series[-1]}")
+        return lines
+
+
+_metrics = []
+
+STAGE_SECONDS = Histogram('label_to_pdf_stage_seconds', '各渲染/拉取阶段耗时', ('stage',))
+REQUEST_SECONDS = Histogram('label_to_pdf_request_seconds', 'HTTP 请求总耗时', ('endpoint',))
+REQUESTS_TOTAL = Counter('label_to_pdf_requests_total', 'HTTP 请求数', ('endpoint', 'status'))
+RENDER_ANNOTATIONS = Histogram('label_to_pdf_render_annotations', '每页绘制的标注数量', (),
+                               (10, 50, 100, 500, 1000, 2500, 5000, 10000, 25000))
+RENDER_MEGAPIXELS = Histogram('label_to_pdf_render_megapixels', '每页输出图像的像素数（百万）', (),
+                              (1, 2, 5, 10, 20, 36, 50, 100))
+PASSTHROUGH_TOTAL = Counter('label_to_pdf_image_passthrough_total', '页面底图是否原样嵌入 JPEG', ('passthrough',))
+COALESCED_TOTAL = Counter('label_to_pdf_coalesced_total', '与进行中的相同请求合并、未重复执行的次数', ('kind',))
+
+
+class StageTimings:
+    """
+    一次请求内各阶段的累计耗时（秒）和附加信息（标注数量、图像尺寸等）。
+    同一请求的拉取线程也会写入，因此加锁。
+    """
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.info = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def set_info(self, key: str, value):
+        with self._lock:
+            self.info[key] = value
+
+    def server_timing(self, total: float = None) -> str:
+        """格式化为 Server-Timing 头，耗时单位为毫秒。"""
+        with self._lock:
+            parts = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stages.items()]
+            parts += [f'{key};desc="{value}"' for key, value in self.info.items()]
+        if total is not None:
+            parts.append(f"total;dur={total * 1000:.1f}")
+        return ', '.join(parts)
+
+
+_current_timings = ContextVar('stage_timings', default=None)
+
+
+@contextmanager
+def stage(name: str):
+    """
+    计时一个阶段：计入 /metrics 直方图，并在请求上下文中累加到 Server-Timing。
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, name)
+        timings = _current_timings.get()
+        if timings is not None:
+            timings.add(name, elapsed)
+
+
+def record_info(key: str, value):
+    """记录当前请求的附加信息（出现在 Server-Timing 的 desc 中）。"""
+    timings = _current_timings.get()
+    if timings is not None:
+        timings.set_info(key, value)
+
+
+def submit_with_context(executor, fn, *args):
+    """
+    提交到线程池并带上当前 contextvars，使工作线程中的阶段计时归入发起请求。
+    """
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
 # -------------------------------
 # 工具函数
 # -------------------------------
 
+class SingleFlight:
+    """
+    合并进程内同时进行的相同调用：同一 key 只有第一个调用者真正执行 fn，
+    其余调用者等待并拿到同一个结果（或同一个异常）。调用结束即移除，不做缓存。
+    do() 返回 (结果, shared)，shared 表示结果来自其他调用者，可变对象（如文件）不能直接复用。
+    """
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            COALESCED_TOTAL.inc(self.kind)
+            record_info(f'{self.kind}_coalesced', 'yes')
+            return future.result(), True
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+# 文字宽度缓存条目数（按文本）
+TEXT_WIDTH_CACHE_SIZE = 8192
+
+
+@lru_cache(maxsize=TEXT_WIDTH_CACHE_SIZE)
+def _unit_text_width(text: str) -> float:
+    return stringWidth(text, 'DejaVuSans', 1)
+
+
+def measure_text(text: str, font_size: float) -> float:
+    """
+    DejaVuSans 下的文字宽度。宽度与字号成正比，按 1 号字缓存每段文字的宽度：
+    同一标签文字在各标注、各页之间大量重复，而字号随框高变化，按 (文字, 字号) 缓存几乎不会命中。
+    """
+    return _unit_text_width(text) * font_size
+
+
 def parse_html_color(color_val, alpha=None):
     """
     将 HTML/CSS 颜色（Hex、名称或RGB）转换为 reportlab Color 对象。
@@ -85,8 +362,87 @@ def parse_html_color(color_val, alpha=None):
         raise ValueError(f"Unknown color name: {color_val}")
 
 
-import re
-from decimal import Decimal, getcontext
+class LabelStyle:
+    """
+    单个标签在渲染器用到的各透明度下的颜色，构造时一次性解析。
+    """
+    __slots__ = ('fill', 'border', 'text_border', 'raw_bg', 'value_bg', 'label_bg')
+
+    def __init__(self, base_color):
+        self.fill = parse_html_color(base_color, alpha=0.15)        # 标注框填充
+        self.border = parse_html_color(base_color, alpha=0.5)       # 标注框边线
+        self.text_border = parse_html_color(base_color, alpha=0.5)  # 换算值文本框边线
+        self.raw_bg = parse_html_color(base_color, alpha=0.2)       # 第二层（原始文字）背景
+        self.value_bg = parse_html_color(base_color, alpha=0.4)     # 第三层（换算值）背景
+        self.label_bg = parse_html_color(base_color, alpha=0.5)     # 普通标签文字背景
+
+
+class StylePalette:
+    """
+    按 color_map 预先构建的调色板：标签 -> LabelStyle，外加与标签无关的文字颜色。
+    渲染时只查表，不再重复解析颜色字符串。
+    """
+    DEFAULT_COLOR = '#00ff00'
+
+    def __init__(self, color_map: dict):
+        self._styles = {label: LabelStyle(color) for label, color in color_map.items()}
+        self._default = LabelStyle(self.DEFAULT_COLOR)
+        self.font = parse_html_color('white', alpha=0.8)
+        self.font_small = parse_html_color('white', alpha=0.7)
+        self.font_raw = parse_html_color('white', alpha=0.85)
+        self.font_label = parse_html_color('white', alpha=0.9)
+
+    def get(self, label) -> LabelStyle:
+        return self._styles.get(label, self._default)
+
+
+_palette_cache = OrderedDict()
+_palette_lock = threading.Lock()
+
+
+def get_style_palette(color_map: dict) -> StylePalette:
+    """
+    返回 color_map 对应的调色板，按颜色配置内容做小型 LRU 复用。
+    """
+    key = tuple(sorted(color_map.items(), key=lambda kv: str(kv[0])))
+    with _palette_lock:
+        palette = _palette_cache.get(key)
+        if palette is not None:
+            _palette_cache.move_to_end(key)
+            return palette
+    palette = StylePalette(color_map)
+    with _palette_lock:
+        _palette_cache[key] = palette
+        while len(_palette_cache) > 64:
+            _palette_cache.popitem(last=False)
+    return palette
+
+
+# 单位换算结果缓存条目数（按输入文本）
+CONVERT_CACHE_SIZE = int(os.getenv('convert_cache_size', '65536'))
+# /convert 单次请求最多条目数
+CONVERT_MAX_ITEMS = int(os.getenv('convert_max_items', '100000'))
+
+FRAC_MAP = {
+    (1,2): '½', (1,3): '⅓', (2,3): '⅔',
+    (1,4): '¼', (3,4): '¾',
+    (1,5): '⅕', (2,5): '⅖', (3,5): '⅗', (4,5): '⅘',
+    (1,6): '⅙', (5,6): '⅚',
+    (1,8): '⅛', (3,8): '⅜', (5,8): '⅝', (7,8): '⅞',
+}
+FOOT_TO_M = Decimal('0.3048')
+INCH_TO_M = Decimal('0.0254')
+
+_LENGTH_RE = re.compile(
+    r"""^\s*
+        (?:(\d+)\s*')?            # group1: feet
+        \s*(\d+)?                 # group2: inches integer
+        (?:\s+(\d+)\s*/\s*(\d+))? # group3/4: fraction
+        \s*"?\s*$""",
+    re.VERBOSE
+)
+_FRACTION_RE = re.compile(r"""^\s*(\d+)\s*/\s*(\d+)\s*"?\s*$""")
+
 
 def convert_length_text(text: str) -> dict[str, str]:
     """
@@ -99,17 +455,15 @@ def convert_length_text(text: str) -> dict[str, str]:
     输出示例： 5' 0" ↦ 1.524 m
     解析失败则返回原文本。
     """
-    frac_map = {
-        (1,2): '½', (1,3): '⅓', (2,3): '⅔',
-        (1,4): '¼', (3,4): '¾',
-        (1,5): '⅕', (2,5): '⅖', (3,5): '⅗', (4,5): '⅘',
-        (1,6): '⅙', (5,6): '⅚',
-        (1,8): '⅛', (3,8): '⅜', (5,8): '⅝', (7,8): '⅞',
-    }
-    getcontext().prec = 10
-    FOOT_TO_M = Decimal('0.3048')
-    INCH_TO_M = Decimal('0.0254')
+    result = _convert_length_cached(text)
+    return dict(result) if isinstance(result, tuple) else result
+
 
+@lru_cache(maxsize=CONVERT_CACHE_SIZE)
+def _convert_length_cached(text: str):
+    """
+    convert_length_text 的带缓存实现，返回 (key, value) 元组，避免调用方改动缓存里的结果。
+    """
     s = text.strip()
     parts = s.replace('"','').split()
     show_inches = False
@@ -129,14 +483,7 @@ def convert_length_text(text: str) -> dict[str, str]:
                     return text  # 不合法，原样返回
     else:
         # ——— 2. 标准格式 ———
-        m = re.match(
-            r"""^\s*
-                (?:(\d+)\s*')?            # group1: feet
-                \s*(\d+)?                 # group2: inches integer
-                (?:\s+(\d+)\s*/\s*(\d+))? # group3/4: fraction
-                \s*"?\s*$""",
-            s, re.VERBOSE
-        )
+        m = _LENGTH_RE.match(s)
         if m:
             feet   = int(m.group(1)) if m.group(1) else 0
             inches = int(m.group(2)) if m.group(2) else 0
@@ -145,10 +492,7 @@ def convert_length_text(text: str) -> dict[str, str]:
             show_inches = m.group(2) is not None
         else:
             # ——— 3. 只含分数，如 "1/2" 或 ' 3 / 4 "' ———
-            m2 = re.match(
-                r"""^\s*(\d+)\s*/\s*(\d+)\s*"?\s*$""",
-                s
-            )
+            m2 = _FRACTION_RE.match(s)
             if m2:
                 num, den = int(m2.group(1)), int(m2.group(2))
                 feet = inches = 0
@@ -156,16 +500,18 @@ def convert_length_text(text: str) -> dict[str, str]:
             else:
                 return text  # 无法解析，返回原文本
 
-    # ——— 统一计算米值 ———
-    total_m = (
-        Decimal(feet) * FOOT_TO_M +
-        Decimal(inches) * INCH_TO_M +
-        (Decimal(num) / Decimal(den) * INCH_TO_M if den else Decimal(0))
-    )
+    # ——— 统一计算米值（局部精度上下文，不修改全局 Decimal 设置）———
+    with localcontext() as ctx:
+        ctx.prec = 10
+        total_m = (
+            Decimal(feet) * FOOT_TO_M +
+            Decimal(inches) * INCH_TO_M +
+            (Decimal(num) / Decimal(den) * INCH_TO_M if den else Decimal(0))
+        )
     meters_str = f"{total_m:.3f}"
 
     # ——— 构造英寸文本 ———
-    frac_txt = frac_map.get((num, den), f"{num}/{den}") if den else ''
+    frac_txt = FRAC_MAP.get((num, den), f"{num}/{den}") if den else ''
     if inches == 0 and frac_txt:
         inch_txt = f'{frac_txt}"'
     elif frac_txt:
@@ -183,10 +529,10 @@ def convert_length_text(text: str) -> dict[str, str]:
     else:
         feet_inch_text = inch_txt
 
-    return {
-        "feet_inch_text": feet_inch_text,
-        "meters_text": meters_str
-    }
+    return (
+        ("feet_inch_text", feet_inch_text),
+        ("meters_text", meters_str)
+    )
 
 
 
@@ -202,383 +548,2544 @@ def convert_bearing_text(text: str) -> dict[str, str]:
       "rev_cad_deg_text": "..."
     }
     """
+    return dict(_convert_bearing_cached(text))
+
+
+@lru_cache(maxsize=CONVERT_CACHE_SIZE)
+def _convert_bearing_cached(text: str) -> tuple:
     parts = text.strip().split()
     try:
         d = Decimal(parts[0]) if parts and parts[0] else Decimal(0)
         m = Decimal(parts[1]) if len(parts) > 1 else Decimal(0)
         s = Decimal(parts[2]) if len(parts) > 2 else Decimal(0)
-        getcontext().prec = 10
+        with localcontext() as ctx:
+            ctx.prec = 10
 
-        # 1) 原始十进制度数
-        deg = d + m/Decimal(60) + s/Decimal(3600)
+            # 1) 原始十进制度数
+            deg = d + m/Decimal(60) + s/Decimal(3600)
 
-        # 2) 归一化到 [0,360)
-        deg_norm = deg % Decimal(360)
+            # 2) 归一化到 [0,360)
+            deg_norm = deg % Decimal(360)
 
-        # 3) 正向 CAD 角度（0°=东，逆时针为正）
-        cad_deg = (Decimal(90) - deg_norm) % Decimal(360)
+            # 3) 正向 CAD 角度（0°=东，逆时针为正）
+            cad_deg = (Decimal(90) - deg_norm) % Decimal(360)
 
-        # 4) 反向 CAD 角度：在正向角度上加 180°（并归一化）
-        rev_cad_deg = (cad_deg + Decimal(180)) % Decimal(360)
+            # 4) 反向 CAD 角度：在正向角度上加 180°（并归一化）
+            rev_cad_deg = (cad_deg + Decimal(180)) % Decimal(360)
 
         # 5) 构造 DMS 文本（位不足不补0）
         def pad(v):
             return str(int(v))
         dms_str = f"{pad(d)}° {pad(m)}′ {pad(s)}″"
 
-        return {
-            "dms_text": dms_str,
-            "deg_text":       f"{deg:.3f}",
-            "cad_deg_text":   f"{cad_deg:.3f}",
-            "rev_cad_deg_text": f"{rev_cad_deg:.3f}"
-        }
+        return (
+            ("dms_text", dms_str),
+            ("deg_text",       f"{deg:.3f}"),
+            ("cad_deg_text",   f"{cad_deg:.3f}"),
+            ("rev_cad_deg_text", f"{rev_cad_deg:.3f}")
+        )
     except Exception:
         # 出错时也返回四个字段，保证调用处不报 KeyError
-        return {
-            "dms_text": text,
-            "deg_text": "",
-            "cad_deg_text": "",
-            "rev_cad_deg_text": ""
-        }
+        return (
+            ("dms_text", text),
+            ("deg_text", ""),
+            ("cad_deg_text", ""),
+            ("rev_cad_deg_text", "")
+        )
 
 
-def load_annotations(task_json: dict) -> tuple[list, list]:
+class Annotation:
     """
-    从 Task JSON 提取标注与关系。
-    返回 (annotations, relations)。
+    单个框选标注（矩形/多边形）及其识别文字、标签。
+    Length / Bearing 标签的单位换算结果在加载时解析一次，存放在 length / bearing 中；
+    长度文本无法解析（如 "approx 5m"）时 length 为 None，渲染时按普通标签显示原文。
     """
-    annotations, relations = [], []
+    __slots__ = ('id', 'type', 'value', 'text', 'label', 'length', 'bearing')
+
+    def __init__(self, eid, type_, value, text, label):
+        self.id = eid
+        self.type = type_
+        self.value = value
+        self.text = text
+        self.label = label
+        length = convert_length_text(text) if label == 'Length' else None
+        # 解析失败时 convert_length_text 返回原文本
+        self.length = length if isinstance(length, dict) else None
+        self.bearing = convert_bearing_text(text) if label == 'Bearing' else None
+
+
+class AnnotationSet:
+    """
+    load_annotations 的返回值：按出现顺序保存标注，并建立 id 索引和双向关系邻接表。
+    outgoing[from_id] / incoming[to_id] 为 [(对端 id, 关系标签元组), ...]，同一标注的多条关系全部保留。
+    """
+    __slots__ = ('items', 'by_id', 'relations', 'outgoing', 'incoming')
+
+    def __init__(self, items: list, relations: list):
+        self.items = items
+        self.by_id = {a.id: a for a in items}
+        self.relations = relations
+        self.outgoing, self.incoming = {}, {}
+        for from_id, to_id, labels in relations:
+            self.outgoing.setdefault(from_id, []).append((to_id, labels))
+            self.incoming.setdefault(to_id, []).append((from_id, labels))
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, eid):
+        return self.by_id.get(eid)
+
+    def related(self, eid, label=None, direction='out') -> list:
+        """
+        返回与 eid 有关系的标注，direction 为 'out'（eid 指向对方）或 'in'（对方指向 eid），
+        label 非空时只保留该标签的标注。
+        """
+        edges = (self.outgoing if direction == 'out' else self.incoming).get(eid, ())
+        found = []
+        for other_id, _ in edges:
+            other = self.by_id.get(other_id)
+            if other is not None and (label is None or other.label == label):
+                found.append(other)
+        return found
+
+
+def load_annotations(task_json: dict, annotation: dict = None) -> AnnotationSet:
+    """
+    从 Task JSON 提取标注与关系，返回建好索引的 AnnotationSet。
+    annotation 为 task_json['annotations'] 中的某一份标注（见 select_annotations），默认取第一份。
+    """
+    relations = []
     rect_map, text_map, label_map = {}, {}, {}
-    results = task_json.get('annotations', [{}])[0].get('result', [])
+    if annotation is None:
+        annotation = (task_json.get('annotations') or [{}])[0]
+    results = annotation.get('result', [])
     for item in results:
         if item.get('type') == 'relation':
-            relations.append({'from_id': item['from_id'], 'to_id': item['to_id']})
+            relations.append((item['from_id'], item['to_id'], tuple(item.get('labels') or ())))
             continue
         if 'id' not in item:
             continue
         eid, t = item['id'], item['type']
         if t in ('rectangle', 'polygon'):
-            rect_map[eid] = item['value']
+            rect_map[eid] = (t, item['value'])
         elif t == 'labels':
             labs = item['value'].get('labels', [])
             if labs: label_map[eid] = labs[0]
         elif t == 'textarea':
             text_map[eid] = ''.join(item['value'].get('text', []))
-    for eid, val in rect_map.items():
-        annotations.append({'id': eid, 'type': 'rectangle', 'value': val,
-                            'text': text_map.get(eid, ''), 'label': label_map.get(eid)})
-    return annotations, relations
+    annotations = [Annotation(eid, t, val, text_map.get(eid, ''), label_map.get(eid))
+                   for eid, (t, val) in rect_map.items()]
+    return AnnotationSet(annotations, relations)
+
+
+def select_annotations(task_json: dict, selector) -> list:
+    """
+    按 selector 选出任务中的多份标注：'all' 为全部未取消的标注，否则为标注 ID 列表（按给定顺序）。
+    没有可用标注或 ID 不存在时抛出 ValueError。
+    """
+    annotations = task_json.get('annotations') or []
+    if selector == 'all':
+        selected = [a for a in annotations if not a.get('was_cancelled')]
+    else:
+        by_id = {str(a.get('id')): a for a in annotations}
+        missing = [str(i) for i in selector if str(i) not in by_id]
+        if missing:
+            raise ValueError(f"任务中没有这些标注：{', '.join(missing)}")
+        selected = [by_id[str(i)] for i in selector]
+    if not selected:
+        raise ValueError("任务中没有可用的标注")
+    return selected
+
+
+def annotation_header(annotation: dict) -> str:
+    """页眉文字：标注 ID、标注者与最后修改时间（悉尼时间）。"""
+    user = annotation.get('completed_by')
+    if isinstance(user, dict):
+        author = user.get('email') or user.get('username') or f"user {user.get('id')}"
+    elif annotation.get('created_username'):
+        # 导出格式为 "邮箱, 用户 ID"
+        author = annotation['created_username'].split(',')[0].strip()
+    else:
+        author = f"user {user}" if user is not None else 'unknown'
+    updated = annotation.get('updated_at') or annotation.get('created_at')
+    return f"Annotation #{annotation.get('id')} / {author} / {format_sydney_time(updated) if updated else '-'}"
 
 
 def annotate_image_to_pdf(
-    image: Image.Image,
-    annotations: list,
-    relations: list,
-    output_buffer: BytesIO,
+    image,
+    annotations: AnnotationSet,
+    output_buffer,
     color_map: dict,
-    pdf_title: str
+    pdf_title: str,
+    max_dimension=MAX_DIMENSION
 ):
-    # 获取图像原始宽高
-    image_width, image_height = image.size
-
-    # 限制最大图像尺寸，防止太大导致PDF异常
-    max_dimension = 6000
-    if max(image_width, image_height) > max_dimension:
-        resize_ratio = max_dimension / max(image_width, image_height)
-        image = image.resize(
-            (int(image_width * resize_ratio), int(image_height * resize_ratio)), 
-            Image.LANCZOS
+    """
+    生成单页带注释的 PDF，写入 output_buffer（任意可写的二进制文件对象）。
+    image 可以是 PIL 图像或原始图像字节，见 prepare_page_image；
+    color_map 可以是 标签 -> 颜色 字典，也可以是预先构建好的 StylePalette。
+    """
+    pdf_canvas = canvas.Canvas(output_buffer, pageCompression=True)
+    pdf_canvas.setTitle(pdf_title)
+    draw_annotated_page(pdf_canvas, image, annotations, color_map, max_dimension)
+    with stage('save'), _font_subset_lock:
+        pdf_canvas.save()
+
+
+class JPEGPassthroughReader(ImageReader):
+    """
+    直接嵌入 JPEG 字节的 ImageReader。
+    reportlab 的 drawImage 会调用 getRGBData() 计算图像指纹，默认实现要完整解码像素；
+    这里改为用压缩字节本身做指纹，嵌入时仍走 jpeg_fh 原样写入 DCTDecode 流。
+    """
+    _dataA = None
+
+    def getRGBData(self):
+        return self.fp.getvalue()
+
+
+def fit_image_size(size: tuple, max_dimension=None, max_pixels=None) -> tuple:
+    """
+    计算输出尺寸：长边不超过 max_dimension，像素总数不超过 max_pixels（None 表示不限制）。
+    """
+    width, height = size
+    ratio = 1.0
+    if max_dimension and max(width, height) > max_dimension:
+        ratio = max_dimension / max(width, height)
+    if max_pixels and width * height * ratio * ratio > max_pixels:
+        ratio = min(ratio, math.sqrt(max_pixels / (width * height)))
+    if ratio >= 1.0:
+        return width, height
+    return max(1, int(width * ratio)), max(1, int(height * ratio))
+
+
+def can_passthrough(image: Image.Image, max_dimension=MAX_DIMENSION, max_pixels=MAX_DECODE_PIXELS) -> bool:
+    """
+    仅凭文件头判断能否原样嵌入：基线 RGB/灰度 JPEG，且无需缩小。
+    """
+    return (image.format == 'JPEG' and image.mode in ('RGB', 'L')
+            and not image.info.get('progressive')
+            and fit_image_size(image.size, max_dimension, max_pixels) == image.size)
+
+
+def decode_image(data: bytes, max_dimension=MAX_DIMENSION, max_pixels=MAX_DECODE_PIXELS) -> Image.Image:
+    """
+    把图像字节解码为 RGB。
+    需要缩小的 JPEG 用 draft 模式在 DCT 阶段按 1/2、1/4、1/8 缩放解码，
+    不会先生成用不到的全分辨率像素；解码后仍超过 max_pixels 的图像直接拒绝。
+    """
+    image = Image.open(BytesIO(data))
+    target_size = fit_image_size(image.size, max_dimension, max_pixels)
+    if image.format == 'JPEG' and target_size != image.size:
+        # draft 只能按 1/2、1/4、1/8 缩小：先取不小于目标尺寸的最大比例，
+        # 若解码像素仍超出预算则继续加大比例（最终尺寸可能略小于目标）
+        width, height = image.size
+        scale = next((s for s in (8, 4, 2) if width // s >= target_size[0] and height // s >= target_size[1]), 1)
+        while max_pixels and scale < 8 and (width // scale) * (height // scale) > max_pixels:
+            scale *= 2
+        if scale > 1:
+            image.draft('RGB', (max(1, width // scale), max(1, height // scale)))
+    if max_pixels and image.width * image.height > max_pixels:
+        raise ImageTooLargeError(
+            f"图像 {image.width}x{image.height} 解码后超过像素上限 {max_pixels}，"
+            f"请使用较低的 quality 或调大 max_decode_pixels"
         )
-        image_width, image_height = image.size
+    if image.mode == 'RGB':
+        # convert 同模式时会复制一份像素，这里直接解码原对象
+        image.load()
+        return image
+    rgb = image.convert('RGB')
+    image.close()
+    return rgb
+
+
+def resize_image(image: Image.Image, max_dimension=MAX_DIMENSION, max_pixels=MAX_DECODE_PIXELS) -> Image.Image:
+    """
+    限制最大图像尺寸，防止太大导致PDF异常。
+    """
+    target_size = fit_image_size(image.size, max_dimension, max_pixels)
+    if image.size != target_size:
+        image = image.resize(target_size, Image.LANCZOS, reducing_gap=3.0)
+    return image
 
-    # 创建 PDF 画布
-    pdf_canvas = canvas.Canvas(output_buffer, pagesize=(image_width, image_height), pageCompression=True)
-    pdf_canvas.setTitle(pdf_title)
 
-    # 将原始图像绘制到PDF底层
+def encode_jpeg(image: Image.Image) -> BytesIO:
     image_buffer = BytesIO()
     image.save(image_buffer, format='JPEG', quality=80, optimize=True)
     image_buffer.seek(0)
-    pdf_canvas.drawImage(ImageReader(image_buffer), 0, 0, width=image_width, height=image_height)
-
-
+    return image_buffer
 
-    # 构建 ID -> 关联ID 的字典（如长度和方向的配对关系）
-    annotation_relation_map = {relation['from_id']: relation['to_id'] for relation in relations}
 
-    for annotation in annotations:
-        # 只处理矩形和多边形类型的标注
-        if annotation['type'] not in ('rectangle', 'polygon'):
-            continue
+def prepare_page_image(image, max_dimension=MAX_DIMENSION, max_pixels=MAX_DECODE_PIXELS):
+    """
+    把源图像准备成可绘制的 (reader, width, height)。
+    image 为原始字节时只读文件头：已是基线 RGB/灰度 JPEG 且不超过 max_dimension 的，
+    原样嵌入，不解码也不重新压缩；只有需要缩放或转换色彩空间时才完整解码。
+    """
+    owned = isinstance(image, (bytes, bytearray))
+    if owned:
+        data = image
+        header = Image.open(BytesIO(data))
+        if can_passthrough(header, max_dimension, max_pixels):
+            PASSTHROUGH_TOTAL.inc('yes')
+            return JPEGPassthroughReader(BytesIO(data)), header.width, header.height
+        PASSTHROUGH_TOTAL.inc('no')
+        with stage('decode'):
+            image = decode_image(data, max_dimension, max_pixels)
+        del data, header
+
+    # 自己解码出来的中间图像用完立即 close 释放像素内存，不等垃圾回收；调用方传入的 PIL 图像不动
+    with stage('resize'):
+        resized = resize_image(image, max_dimension, max_pixels)
+    if owned and resized is not image:
+        image.close()
+    owned = owned or resized is not image
+    image_width, image_height = resized.size
+    with stage('encode'):
+        image_buffer = encode_jpeg(resized)
+    if owned:
+        resized.close()
+    return JPEGPassthroughReader(image_buffer), image_width, image_height
+
+
+def draw_annotated_page(
+    pdf_canvas: canvas.Canvas,
+    image,
+    annotations: AnnotationSet,
+    color_map: dict,
+    max_dimension=MAX_DIMENSION,
+    bookmark: tuple = None
+):
+    """
+    在 pdf_canvas 上新起一页：底层绘制图像，上层绘制标注。
+    image 可以是 PIL 图像，也可以是原始图像字节（JPEG 可免解码直接嵌入）。
+    页面尺寸跟随图像，因此同一个画布可以连续绘制多张不同尺寸的任务。
+    bookmark 为 (书签键, 目录标题)，绘制成功后才加入目录。
+    绘制中途出错时丢弃这一页已写入的内容再抛出，画布仍可继续绘制下一页。
+    """
+    try:
+        # 按文件头估算的内存占用排队，解码与绘制在准入之后进行
+        with _admission.admit(estimate_render_cost(image, len(annotations), max_dimension)):
+            reader, image_width, image_height = prepare_page_image(image, max_dimension)
+
+            # 当前页尺寸与图像一致
+            pdf_canvas.setPageSize((image_width, image_height))
+
+            # 将原始图像绘制到PDF底层
+            with stage('embed'):
+                pdf_canvas.drawImage(reader, 0, 0, width=image_width, height=image_height)
+            del reader
+
+            with stage('overlay'):
+                draw_annotations(pdf_canvas, annotations, color_map, image_width, image_height)
+    except BaseException:
+        # reportlab 没有公开的丢弃当前页接口，按 Canvas._startPage 的做法重置页面内容与图形状态
+        pdf_canvas._restartAccumulators()
+        pdf_canvas.init_graphics_state()
+        pdf_canvas.state_stack = []
+        raise
+    RENDER_ANNOTATIONS.observe(len(annotations))
+    RENDER_MEGAPIXELS.observe(image_width * image_height / 1e6)
+    record_info('annotations', len(annotations))
+    record_info('image', f"{image_width}x{image_height}")
+
+    if bookmark is not None:
+        pdf_canvas.bookmarkPage(bookmark[0])
+        pdf_canvas.addOutlineEntry(bookmark[1], bookmark[0])
+    # 结束当前页
+    pdf_canvas.showPage()
 
-        raw_text = annotation['text']
-        label = annotation['label']
 
-        # 根据类型转换文本，如长度单位或角度
+def annotate_image_variants_to_pdf(
+    image,
+    variants: list,
+    output_buffer,
+    color_map: dict,
+    pdf_title: str,
+    max_dimension=MAX_DIMENSION
+):
+    """
+    同一张图像的多份标注各占一页：variants 为 [(页眉文字, AnnotationSet)]。
+    图像只解码/编码一次，各页复用同一个 reader，reportlab 按内容指纹只写入一个图像 XObject。
+    """
+    palette = color_map if isinstance(color_map, StylePalette) else get_style_palette(color_map)
+    pdf_canvas = canvas.Canvas(output_buffer, pageCompression=True)
+    pdf_canvas.setTitle(pdf_title)
+    total = sum(len(annotations) for _, annotations in variants)
+    with _admission.admit(estimate_render_cost(image, total, max_dimension)):
+        reader, image_width, image_height = prepare_page_image(image, max_dimension)
+        header_size = max(12, image_height / 60)
+        for header, annotations in variants:
+            pdf_canvas.setPageSize((image_width, image_height))
+            pdf_canvas.bookmarkPage(header)
+            pdf_canvas.addOutlineEntry(header, header)
+            with stage('embed'):
+                pdf_canvas.drawImage(reader, 0, 0, width=image_width, height=image_height)
+            with stage('overlay'):
+                draw_annotations(pdf_canvas, annotations, palette, image_width, image_height)
+                # 页眉画在图像顶部，覆盖在标注之上
+                pdf_canvas.setFillColor(Color(1, 1, 1, alpha=0.85))
+                pdf_canvas.rect(0, image_height - header_size * 1.8, image_width, header_size * 1.8, fill=1, stroke=0)
+                pdf_canvas.setFillColor(Color(0, 0, 0))
+                pdf_canvas.setFont('DejaVuSans', header_size)
+                pdf_canvas.drawString(header_size / 2, image_height - header_size * 1.3, header)
+            RENDER_ANNOTATIONS.observe(len(annotations))
+            pdf_canvas.showPage()
+        del reader
+    RENDER_MEGAPIXELS.observe(image_width * image_height / 1e6)
+    record_info('annotations', total)
+    record_info('variants', len(variants))
+    record_info('image', f"{image_width}x{image_height}")
+    with stage('save'), _font_subset_lock:
+        pdf_canvas.save()
+
+
+def annotation_geometry(annotations: list, image_width: float, image_height: float) -> list:
+    """
+    一次性把全部标注从百分比换算为页面坐标（y 轴向上），返回与 annotations 一一对应的
+    [(轮廓, 是否闭合, 框坐标系, 框宽, 框高)]：
+      轮廓     PDF 路径构造操作符（m / l，不含闭合与绘制操作），矩形为旋转后的四个角，多边形为 points
+      框坐标系 6 个仿射参数 (a, b, c, d, e, f)，框内坐标 (x, y) 对应页面 (a·x + c·y + e, b·x + d·y + f)；
+               原点在框上边的中点，x 轴沿上边方向，框占 x ∈ [-宽/2, 宽/2]、y ∈ [-高, 0]；多边形取外接矩形，不旋转
+    矩形与多边形各用一次 NumPy 向量运算完成换算。
+    """
+    import numpy as np
+
+    geometry = [None] * len(annotations)
+    rects = [i for i, a in enumerate(annotations) if a.type == 'rectangle']
+    polygons = [i for i, a in enumerate(annotations) if a.type == 'polygon']
+
+    if rects:
+        v = np.array([(a.value['x'], a.value['y'], a.value['width'], a.value['height'], a.value.get('rotation', 0))
+                      for a in (annotations[i] for i in rects)], dtype=float)
+        left = v[:, 0] / 100 * image_width
+        top = image_height - v[:, 1] / 100 * image_height
+        width = v[:, 2] / 100 * image_width
+        height = v[:, 3] / 100 * image_height
+        # Label Studio 的 rotation 为顺时针角度，绕左上角旋转
+        theta = np.radians(-v[:, 4])
+        cos, sin = np.cos(theta), np.sin(theta)
+        # 框内坐标 (0, 0) (w, 0) (w, -h) (0, -h) 依次为左上、右上、右下、左下
+        lx = np.stack([np.zeros_like(width), width, width, np.zeros_like(width)], axis=1)
+        ly = np.stack([np.zeros_like(height), np.zeros_like(height), -height, -height], axis=1)
+        px = left[:, None] + lx * cos[:, None] - ly * sin[:, None]
+        py = top[:, None] + lx * sin[:, None] + ly * cos[:, None]
+        corners = np.stack([px, py], axis=2).reshape(len(rects), 8).round(2).tolist()
+        frames = np.stack([cos, sin, -sin, cos, left + width / 2 * cos, top + width / 2 * sin], axis=1).tolist()
+        for i, points, frame, w, h in zip(rects, corners, frames, width.tolist(), height.tolist()):
+            geometry[i] = ('%s %s m %s %s l %s %s l %s %s l' % tuple(points), True, frame, w, h)
+
+    if polygons:
+        counts = [len(annotations[i].value['points']) for i in polygons]
+        points = np.array([p[:2] for i in polygons for p in annotations[i].value['points']], dtype=float)
+        points = points.reshape(-1, 2)
+        points[:, 0] = points[:, 0] / 100 * image_width
+        points[:, 1] = image_height - points[:, 1] / 100 * image_height
+        offset = 0
+        for i, count in zip(polygons, counts):
+            shape = points[offset:offset + count]
+            offset += count
+            if not count:
+                geometry[i] = ('', False, (1, 0, 0, 1, 0, 0), 0, 0)
+                continue
+            x0, y0 = shape.min(axis=0).tolist()
+            x1, y1 = shape.max(axis=0).tolist()
+            coords = shape.round(2).tolist()
+            outline = ' '.join(['%s %s m' % tuple(coords[0])] + ['%s %s l' % tuple(p) for p in coords[1:]])
+            closed = annotations[i].value.get('closed') is not False
+            geometry[i] = (outline, closed, (1, 0, 0, 1, (x0 + x1) / 2, y1), x1 - x0, y1 - y0)
+
+    return geometry
+
+
+def annotation_labels(annotation, annotations: AnnotationSet, style, palette, box_width: float, box_height: float):
+    """
+    标注文字层的图元，坐标在框坐标系中（见 annotation_geometry），返回 (背景框列表, 文字列表)：
+      背景框 (x, y, 宽, 高, 填充色, 描边色或 None, 是否为整框底色)
+      文字   (中心 x, 基线 y, 文字, 字号, 颜色)
+    整框底色对多边形改为填充多边形本身（由调用方处理）。
+    """
+    raw_text = annotation.text
+    label = annotation.label
+    length, bearing = annotation.length, annotation.bearing
+    rects, strings = [], []
+    if label == 'Length' and length is None:
+        # 长度文本无法解析，按普通标签显示原文
+        label = None
+
+    # 根据类型转换文本，如长度单位或角度（换算结果在加载时已解析）
+    if label == 'Length':
+        display_text = length['meters_text']
+    elif label == 'Bearing':
+        display_text = bearing['deg_text']
+    else:
+        display_text = raw_text
+
+    # 如果是长度且有关联的方向信息，拼接方向信息（通过关系索引查找；有多条关系时取第一个关联的 Bearing）
+    if label == 'Length':
+        related_bearings = annotations.related(annotation.id, label='Bearing')
+        if related_bearings:
+            bearing_text = related_bearings[0].bearing['deg_text']
+            display_text = f"@{display_text}<{bearing_text}"
+
+    if label in ('Length', 'Bearing'):
+        # 文字边距
+        padding = box_height / 30
         if label == 'Length':
-            display_text = convert_length_text(raw_text)['meters_text']
-        elif label == 'Bearing':
-            display_text = convert_bearing_text(raw_text)['deg_text']
+            raw_value = length['feet_inch_text']
+            small_text = small_width_text = length['feet_inch_text'] + '↦' + display_text
         else:
-            display_text = raw_text
-
-        # 如果是长度且有关联的方向信息，拼接方向信息
-        if label == 'Length' and annotation['id'] in annotation_relation_map:
-            bearing_id = annotation_relation_map[annotation['id']]
-            bearing_annotation = next(
-                (a for a in annotations if a['id'] == bearing_id and a['label'] == 'Bearing'),
-                None
-            )
-            if bearing_annotation:
-                bearing_text = convert_bearing_text(bearing_annotation['text'])['deg_text']
-                display_text = f"@{display_text}<{bearing_text}"
-
-        # 获取颜色设置（含透明度）
-        base_color = color_map.get(label, '#00ff00')
-        fill_color = parse_html_color(base_color, alpha=0.15)
-        border_color = parse_html_color(base_color, alpha=0.5)
-        text_bg_color = parse_html_color(base_color, alpha=0.6)
-        text_border_color = parse_html_color(base_color, alpha=0.5)
-        font_color = parse_html_color('white', alpha=0.8)
-
-        # 解析位置和大小百分比为实际坐标
-        value = annotation['value']
-        center_x = value['x'] / 100 * image_width
-        center_y = image_height - (value['y'] / 100 * image_height)
-        box_width = value['width'] / 100 * image_width
-        box_height = value['height'] / 100 * image_height
-        rotation = -value.get('rotation', 0)  # 注意是负值
-
-        # 保存当前画布状态以便恢复
+            raw_value, display_text = bearing['dms_text'], bearing['deg_text']
+            # 背景框按带空格的文字计算宽度，实际绘制不带空格
+            small_width_text = bearing['dms_text'] + ' ∢ ' + bearing['deg_text']
+            small_text = bearing['dms_text'] + '∢' + bearing['deg_text']
+
+        if box_height < 1:
+            # 框太矮：原始文字与换算值合为一行，固定字号画在框下边
+            font_size = 10
+            box_total_width = max(measure_text(small_width_text, font_size) + 2 * padding, box_width)
+            box_total_height = font_size + 2 * padding
+            text_box_y_offset = -box_height
+            rects.append((-box_total_width / 2, text_box_y_offset, box_total_width, box_total_height,
+                          style.value_bg, style.text_border, False))
+            strings.append((0, text_box_y_offset + padding * 3, small_text, font_size, palette.font_small))
+        else:  # 高度足够的情况
+            font_size = box_height / 2.3
+            # 第二层文字 识别原始文字
+            box_total_width = max(measure_text(raw_value, font_size) + 2 * padding, box_width)
+            box_total_height = font_size + 2 * padding
+            rects.append((-box_total_width / 2, -box_height, box_width, box_height, style.raw_bg, None, True))
+            strings.append((0, -box_total_height + padding * 3, raw_value, font_size, palette.font_raw))
+            # 第三层文字 换算值
+            box_total_width = max(measure_text(display_text, font_size) + 2 * padding, box_width)
+            rects.append((-box_total_width / 2, -box_height, box_total_width, box_total_height,
+                          style.value_bg, style.text_border, False))
+            strings.append((0, -box_height + padding * 3, display_text, font_size, palette.font))
+    else:
+        # 第一层文字背景框和文字(居中的)
+        padding = 1
+        font_size = 26
+        box_total_width = measure_text(display_text, font_size) + 5 * padding
+        box_total_height = font_size + 2 * padding
+        text_box_y_offset = -box_height / 2 - font_size / 2
+        rects.append((-box_total_width / 2, text_box_y_offset, box_total_width, box_total_height,
+                      style.label_bg, None, False))
+        strings.append((0, text_box_y_offset + padding * 6, display_text, font_size, palette.font_label))
+    return rects, strings
+
+
+def draw_annotations(
+    pdf_canvas: canvas.Canvas,
+    annotations: AnnotationSet,
+    color_map: dict,
+    image_width: float,
+    image_height: float,
+    only=None
+):
+    """
+    在当前页上绘制全部标注（不含底图，也不结束页面）。
+    标注坐标为百分比，由 annotation_geometry 批量换算为页面坐标；各层都按颜色（文字另按字号）分组，
+    每组只设置一次颜色，不再为每个标注保存/恢复画布状态：
+      1. 框与多边形
+      2. 文字背景框（框坐标系中的矩形，批量换算为页面坐标后作为路径输出）
+      3. 文字（每段文字用文本矩阵定位，旋转框内的文字随框旋转）
+    only 给出时只绘制其中的标注（关系仍在完整的 annotations 中查找）。
+    """
+    import numpy as np
+
+    ensure_fonts()
+    palette = color_map if isinstance(color_map, StylePalette) else get_style_palette(color_map)
+
+    # 只处理矩形和多边形类型的标注
+    shapes = [a for a in (annotations if only is None else only) if a.type in ('rectangle', 'polygon')]
+    if not shapes:
+        return
+    geometry = annotation_geometry(shapes, image_width, image_height)
+
+    shape_groups, fills, frames = {}, {}, []
+    rect_rows, rect_keys, text_rows, text_keys = [], [], [], []
+    for annotation, (outline, closed, frame, box_width, box_height) in zip(shapes, geometry):
+        style = palette.get(annotation.label)
+        # 主标注区域（透明背景）
+        if outline:
+            shape_groups.setdefault(id(style), (style.fill, style.border, []))[2].append(
+                outline + (' h B' if closed else ' S'))
+        frame_index = len(frames)
+        frames.append(frame)
+        rects, strings = annotation_labels(annotation, annotations, style, palette, box_width, box_height)
+        for x, y, w, h, fill, stroke, whole_box in rects:
+            if whole_box and annotation.type == 'polygon':
+                # 整框底色只铺在多边形内部
+                if outline and closed:
+                    fills.setdefault((id(fill), None), (fill, None, []))[2].append(outline + ' h f')
+                continue
+            rect_rows.append((frame_index, x, y, w, h))
+            rect_keys.append((fill, stroke))
+        for x, y, text, font_size, color in strings:
+            text_rows.append((frame_index, x - measure_text(text, font_size) / 2, y))
+            text_keys.append((text, font_size, color))
+
+    # 背景框四角与文字原点：框坐标系 -> 页面坐标，一次向量运算
+    frame_array = np.array(frames, dtype=float).reshape(-1, 6)
+    if rect_rows:
+        r = np.array(rect_rows, dtype=float)
+        a, b, c, d, e, f = frame_array[r[:, 0].astype(int)].T
+        lx = np.stack([r[:, 1], r[:, 1] + r[:, 3], r[:, 1] + r[:, 3], r[:, 1]], axis=1)
+        ly = np.stack([r[:, 2], r[:, 2], r[:, 2] + r[:, 4], r[:, 2] + r[:, 4]], axis=1)
+        px = a[:, None] * lx + c[:, None] * ly + e[:, None]
+        py = b[:, None] * lx + d[:, None] * ly + f[:, None]
+        corners = np.stack([px, py], axis=2).reshape(len(rect_rows), 8).round(2).tolist()
+        for points, (fill, stroke) in zip(corners, rect_keys):
+            fills.setdefault((id(fill), id(stroke)), (fill, stroke, []))[2].append(
+                '%s %s m %s %s l %s %s l %s %s l h ' % tuple(points) + ('B' if stroke is not None else 'f'))
+    if text_rows:
+        t = np.array(text_rows, dtype=float)
+        a, b, c, d, e, f = frame_array[t[:, 0].astype(int)].T
+        matrices = np.stack([a, b, c, d, a * t[:, 1] + c * t[:, 2] + e, b * t[:, 1] + d * t[:, 2] + f],
+                            axis=1).round(4).tolist()
+
+    for fill, stroke, paths in list(shape_groups.values()) + list(fills.values()):
         pdf_canvas.saveState()
-        pdf_canvas.translate(center_x, center_y)
-        pdf_canvas.rotate(rotation)
-        pdf_canvas.translate(box_width / 2, 0)
-
-        # 绘制主标注矩形区域（透明背景）
-        pdf_canvas.setFillColor(fill_color)
-        pdf_canvas.setStrokeColor(border_color)
-        pdf_canvas.rect(-box_width / 2, -box_height, box_width, box_height, fill=1, stroke=1)
-
-
-        if label == 'Length' :
-            
-            # 设置字体大小和文字边距
-            font_size = 12
-            padding = box_height/30
-
-            if box_height < 1 :
-                # 第二层文字 识别原始文字
-                # 计算文本框尺寸
-                display_text = convert_length_text(raw_text)['feet_inch_text'] + '↦' + display_text
-                font_size=10
-                text_width = stringWidth(display_text, 'DejaVuSans', font_size)
-                text_height = font_size
-                box_total_width = max(text_width + 2 * padding, box_width)
-                box_total_height = text_height + 2 * padding
-                # text_box_y_offset = 0
-                text_box_y_offset = -box_total_height
-
-                # pdf_canvas.setFillColor(parse_html_color(base_color, alpha=0.3))
-                # pdf_canvas.setStrokeColor(parse_html_color(base_color, alpha=0.4))
-                # pdf_canvas.rect(-box_total_width / 2, -box_height, box_width, box_height, fill=1, stroke=0)
-                # # pdf_canvas.rect(-box_total_width/2 + text_width/2, -box_total_height + padding, text_width, text_height, fill=1, stroke=1)
-                # pdf_canvas.setFillColor(parse_html_color('green', alpha=0.8))
-                # pdf_canvas.setFont('DejaVuSans', font_size)
-                # pdf_canvas.drawCentredString(text_width, text_box_y_offset, convert_length_text(raw_text)['feet_inch_text'])
-
-                # 第三层文字 米换算值
-                # 计算文本框尺寸
-                text_width = stringWidth(display_text, 'DejaVuSans', font_size)
-                text_height = font_size
-                box_total_width = max(text_width + 2 * padding, box_width)
-                box_total_height = text_height + 2 * padding
-                # text_box_y_offset = -box_height - padding
-                text_box_y_offset = -box_height
-
-                pdf_canvas.setFillColor(parse_html_color(base_color, alpha=0.4))
-                pdf_canvas.setStrokeColor(text_border_color)
-                pdf_canvas.rect(-box_total_width / 2, text_box_y_offset, box_total_width, box_total_height, fill=1, stroke=1)
-                pdf_canvas.setFillColor(parse_html_color('white', alpha=0.7))
-                pdf_canvas.setFont('DejaVuSans', font_size)
-                pdf_canvas.drawCentredString(0, text_box_y_offset + padding*3, display_text)
-
-            else : # 高度足够的情况
-
-                font_size = box_height / 2.3
-                # 第二层文字 识别原始文字
-                # 计算文本框尺寸
-                text_width = stringWidth(convert_length_text(raw_text)['feet_inch_text'], 'DejaVuSans', font_size)
-                text_height = font_size
-                box_total_width = max(text_width + 2 * padding, box_width)
-                box_total_height = text_height + 2 * padding
-                # text_box_y_offset = 0
-                text_box_y_offset = -box_total_height
-
-                pdf_canvas.setFillColor(parse_html_color(base_color, alpha=0.2))
-                pdf_canvas.setStrokeColor(parse_html_color(base_color, alpha=0.3))
-                pdf_canvas.rect(-box_total_width / 2, -box_height, box_width, box_height, fill=1, stroke=0)
-                # pdf_canvas.rect(-box_total_width/2 + text_width/2, -box_total_height + padding, text_width, text_height, fill=1, stroke=1)
-                pdf_canvas.setFillColor(parse_html_color('white', alpha=0.85))
-                pdf_canvas.setFont('DejaVuSans', font_size)
-                pdf_canvas.drawCentredString(0, text_box_y_offset + padding*3, convert_length_text(raw_text)['feet_inch_text'])
-
-                # 第三层文字 米换算值
-                # 计算文本框尺寸
-                text_width = stringWidth(display_text, 'DejaVuSans', font_size)
-                text_height = font_size
-                box_total_width = max(text_width + 2 * padding, box_width)
-                box_total_height = text_height + 2 * padding
-                # text_box_y_offset = -box_height - padding
-                text_box_y_offset = -box_height
-
-                pdf_canvas.setFillColor(parse_html_color(base_color, alpha=0.4))
-                pdf_canvas.setStrokeColor(text_border_color)
-                pdf_canvas.rect(-box_total_width / 2, text_box_y_offset, box_total_width, box_total_height, fill=1, stroke=1)
-                pdf_canvas.setFillColor(parse_html_color('white', alpha=0.8))
-                pdf_canvas.setFont('DejaVuSans', font_size)
-                pdf_canvas.drawCentredString(0, text_box_y_offset + padding*3, display_text)
-
-        elif label == 'Bearing' :
-            
-            # 设置字体大小和文字边距
-            font_size = 12
-            padding = box_height/30
-
-
-            if box_height < 1 :
-                # 第二层文字 识别原始文字
-                # 计算文本框尺寸
-                font_size=10
-
-                # pdf_canvas.setFillColor(parse_html_color(base_color, alpha=0.3))
-                # pdf_canvas.setStrokeColor(parse_html_color(base_color, alpha=0.4))
-                # pdf_canvas.rect(-box_total_width / 2, -box_height, box_width, box_height, fill=1, stroke=0)
-                # # pdf_canvas.rect(-box_total_width/2 + text_width/2, -box_total_height + padding, text_width, text_height, fill=1, stroke=1)
-                # pdf_canvas.setFillColor(parse_html_color('green', alpha=0.8))
-                # pdf_canvas.setFont('DejaVuSans', font_size)
-                # pdf_canvas.drawCentredString(text_width, text_box_y_offset, convert_length_text(raw_text)['feet_inch_text'])
-
-                # 第三层文字 角度换算值
-                # 计算文本框尺寸
-                text_width = stringWidth(convert_bearing_text(raw_text)['dms_text'] + ' ∢ ' + convert_bearing_text(raw_text)['deg_text'], 'DejaVuSans', font_size)
-                text_height = font_size
-                box_total_width = max(text_width + 2 * padding, box_width)
-                box_total_height = text_height + 2 * padding
-                # text_box_y_offset = -box_height - padding
-                text_box_y_offset = -box_height
-
-                pdf_canvas.setFillColor(parse_html_color(base_color, alpha=0.4))
-                pdf_canvas.setStrokeColor(text_border_color)
-                pdf_canvas.rect(-box_total_width / 2, text_box_y_offset, box_total_width, box_total_height, fill=1, stroke=1)
-                pdf_canvas.setFillColor(parse_html_color('white', alpha=0.7))
-                pdf_canvas.setFont('DejaVuSans', font_size)
-                pdf_canvas.drawCentredString(0, text_box_y_offset + padding*3, convert_bearing_text(raw_text)['dms_text'] + '∢' + convert_bearing_text(raw_text)['deg_text'])
-
-            else : # 高度足够的情况
-
-                # 第二层文字 识别原始文字
-                # 计算文本框尺寸
-                font_size = box_height / 2.3
-                text_width = stringWidth(convert_bearing_text(raw_text)['dms_text'], 'DejaVuSans', font_size)
-                text_height = font_size
-                box_total_width = max(text_width + 2 * padding, box_width)
-                box_total_height = text_height + 2 * padding
-                # text_box_y_offset = 0
-                text_box_y_offset = -box_total_height
-
-                pdf_canvas.setFillColor(parse_html_color(base_color, alpha=0.2))
-                pdf_canvas.setStrokeColor(parse_html_color(base_color, alpha=0.3))
-                pdf_canvas.rect(-box_total_width / 2, -box_height, box_width, box_height, fill=1, stroke=0)
-                # pdf_canvas.rect(-box_total_width/2 + text_width/2, -box_total_height + padding, text_width, text_height, fill=1, stroke=1)
-                pdf_canvas.setFillColor(parse_html_color('white', alpha=0.85))
-                pdf_canvas.setFont('DejaVuSans', font_size)
-                pdf_canvas.drawCentredString(0, text_box_y_offset + padding*3, convert_bearing_text(raw_text)['dms_text'])
-
-                # 第三层文字 米换算值
-                # 计算文本框尺寸
-                font_size = box_height / 2.3    
-                text_width = stringWidth(convert_bearing_text(raw_text)['deg_text'], 'DejaVuSans', font_size)
-                text_height = font_size
-                box_total_width = max(text_width + 2 * padding, box_width)
-                box_total_height = text_height + 2 * padding
-                # text_box_y_offset = -box_height - padding
-                text_box_y_offset = -box_height
-
-                pdf_canvas.setFillColor(parse_html_color(base_color, alpha=0.4))
-                pdf_canvas.setStrokeColor(text_border_color)
-                pdf_canvas.rect(-box_total_width / 2, text_box_y_offset, box_total_width, box_total_height, fill=1, stroke=1)
-                pdf_canvas.setFillColor(parse_html_color('white', alpha=0.8))
-                pdf_canvas.setFont('DejaVuSans', font_size)
-                pdf_canvas.drawCentredString(0, text_box_y_offset + padding*3, convert_bearing_text(raw_text)['deg_text'])
-
-
-        else :
-
-            padding = 1
-            font_size = 26
-            text_width = stringWidth(display_text, 'DejaVuSans', font_size)
-            box_total_width = text_width + 5 * padding
-            text_height = font_size
-            box_total_height = text_height + 2 * padding
-            text_box_y_offset = -box_height / 2 - text_height / 2
-            
-            # http://127.0.0.1:5001/download?tab=21&task=15&project=27
-
-            # 第一层文字背景框和文字(居中的)
-            pdf_canvas.setFillColor(parse_html_color(base_color, alpha=0.5))
-            pdf_canvas.setStrokeColor(parse_html_color(base_color, alpha=0.5))
-            pdf_canvas.rect(-box_total_width / 2, text_box_y_offset, box_total_width, box_total_height, fill=1, stroke=0)
-            pdf_canvas.setFillColor(parse_html_color('white', alpha=0.9))
-            pdf_canvas.setFont('DejaVuSans', font_size)
-            pdf_canvas.drawCentredString(0, text_box_y_offset + padding*6, display_text)
-        
-
-        # 恢复画布状态（防止旋转影响下一个标注）
+        pdf_canvas.setFillColor(fill)
+        if stroke is not None:
+            pdf_canvas.setStrokeColor(stroke)
+        pdf_canvas.addLiteral('\n'.join(paths))
         pdf_canvas.restoreState()
 
-    # 保存 PDF 页面
-    pdf_canvas.showPage()
-    pdf_canvas.save()
+    if text_rows:
+        # 文字的颜色与透明度留在图形状态中，画完恢复，不影响调用方之后的绘制
+        pdf_canvas.saveState()
+        text_groups = {}
+        for matrix, (text, font_size, color) in zip(matrices, text_keys):
+            text_groups.setdefault(id(color), (color, []))[1].append((font_size, matrix, text))
+        for color, items in text_groups.values():
+            text_object = pdf_canvas.beginText()
+            text_object.setFillColor(color)
+            current_size = None
+            # 同一颜色内按字号排序，字号相同的文字只切换一次字体
+            for font_size, matrix, text in sorted(items, key=lambda item: item[0]):
+                if font_size != current_size:
+                    text_object.setFont('DejaVuSans', font_size)
+                    current_size = font_size
+                # 每段文字都由文本矩阵重新定位，用 textLine 而不是 textOut，省去逐段计算光标前进宽度
+                text_object.setTextTransform(*matrix)
+                text_object.textLine(text)
+            pdf_canvas.drawText(text_object)
+        pdf_canvas.restoreState()
+
+# -------------------------------
+# 分块高分辨率输出
+# -------------------------------
+
+# 分块页的边长与相邻块的重叠（原图像素）
+TILE_SIZE = int(os.getenv('tile_size', '2048'))
+TILE_OVERLAP = int(os.getenv('tile_overlap', '128'))
+# 标注外接框向外扩展的像素数，覆盖画在框外的文字
+TILE_LABEL_MARGIN = 256
+
+
+class GridIndex:
+    """
+    均匀网格空间索引：条目按外接框登记到覆盖的所有格子，查询只检查与查询矩形相交的格子，
+    结果按插入顺序返回（保持标注的绘制先后）。
+    """
+
+    def __init__(self, cell_size: float):
+        self.cell_size = cell_size
+        self._cells = {}
+        self._items = []   # (item, box)
+
+    def _cell_range(self, box):
+        x0, y0, x1, y1 = box
+        c = self.cell_size
+        return range(int(x0 // c), int(x1 // c) + 1), range(int(y0 // c), int(y1 // c) + 1)
+
+    def insert(self, item, box):
+        index = len(self._items)
+        self._items.append((item, box))
+        cols, rows = self._cell_range(box)
+        for cx in cols:
+            for cy in rows:
+                self._cells.setdefault((cx, cy), []).append(index)
+
+    def query(self, box) -> list:
+        x0, y0, x1, y1 = box
+        found = set()
+        cols, rows = self._cell_range(box)
+        for cx in cols:
+            for cy in rows:
+                for index in self._cells.get((cx, cy), ()):
+                    bx0, by0, bx1, by1 = self._items[index][1]
+                    if bx0 <= x1 and bx1 >= x0 and by0 <= y1 and by1 >= y0:
+                        found.add(index)
+        return [self._items[i][0] for i in sorted(found)]
+
+
+def annotation_bounds(annotation, image_width: float, image_height: float):
+    """
+    标注在原图像素坐标中的保守外接框 (x0, y0, x1, y1)，y 轴向下。
+    Label Studio 的矩形绕左上角旋转，旋转时取以左上角为圆心、对角线为半径的外接正方形；
+    另向外扩展 TILE_LABEL_MARGIN 以及框自身的长边，覆盖画在框外的文字。
+    """
+    value = annotation.value
+    if 'points' in value:
+        xs = [p[0] / 100 * image_width for p in value['points']]
+        ys = [p[1] / 100 * image_height for p in value['points']]
+        x0, y0, x1, y1 = min(xs), min(ys), max(xs), max(ys)
+        w, h = x1 - x0, y1 - y0
+    else:
+        x0, y0 = value['x'] / 100 * image_width, value['y'] / 100 * image_height
+        w, h = value['width'] / 100 * image_width, value['height'] / 100 * image_height
+        if value.get('rotation', 0):
+            r = math.hypot(w, h)
+            x0, y0, x1, y1 = x0 - r, y0 - r, x0 + r, y0 + r
+        else:
+            x1, y1 = x0 + w, y0 + h
+    margin = max(w, h) + TILE_LABEL_MARGIN
+    return x0 - margin, y0 - margin, x1 + margin, y1 + margin
+
+
+def tile_starts(length: int, tile_size: int, overlap: int) -> list:
+    """沿一个方向切块的起点：块数取满足重叠不小于 overlap 的最少块数，起点均匀分布，首尾与边缘对齐。"""
+    if length <= tile_size:
+        return [0]
+    count = math.ceil((length - overlap) / max(1, tile_size - overlap))
+    return [round(i * (length - tile_size) / (count - 1)) for i in range(count)]
+
+
+def estimate_tiled_cost(data: bytes, annotation_count: int, tile_size=TILE_SIZE) -> int:
+    header = Image.open(BytesIO(data))
+    return (header.width * header.height * 3 + len(data) * 2 + tile_size * tile_size * 3 * 2
+            + annotation_count * ANNOTATION_COST_BYTES)
+
+
+def annotate_image_to_tiled_pdf(
+    data: bytes,
+    annotations: AnnotationSet,
+    output_buffer,
+    color_map: dict,
+    pdf_title: str,
+    tile_size=TILE_SIZE,
+    overlap=TILE_OVERLAP
+):
+    """
+    按原始分辨率分块输出多页 PDF：第 1 页为总览（缩小的全图 + 全部标注 + 分块网格，点击跳转），
+    之后每页一块，只绘制与该块相交的标注（通过 GridIndex 查找）。
+    局限：JPEG/PNG 无法只解码局部区域，原图需完整解码一次，内存占用约为 解码原图 + 一块，
+    不随分块大小下降。超过 MAX_DECODE_PIXELS 的原图无法按原始分辨率解码，
+    直接抛出 ImageTooLargeError（413），不降采样输出“原始分辨率”的分块。
+    """
+    width, height = Image.open(BytesIO(data)).size
+    if MAX_DECODE_PIXELS and width * height > MAX_DECODE_PIXELS:
+        raise ImageTooLargeError(
+            f"图像 {width}x{height} 超过像素上限 {MAX_DECODE_PIXELS}，无法按原始分辨率分块输出，"
+            f"请调大 max_decode_pixels 或使用 layout=page"
+        )
+    ensure_fonts()
+    palette = color_map if isinstance(color_map, StylePalette) else get_style_palette(color_map)
+    pdf_canvas = canvas.Canvas(output_buffer, pageCompression=True)
+    pdf_canvas.setTitle(pdf_title)
+
+    with _admission.admit(estimate_tiled_cost(data, len(annotations), tile_size)):
+        with stage('decode'):
+            full = decode_image(data, None, MAX_DECODE_PIXELS)
+        xs, ys = tile_starts(width, tile_size, overlap), tile_starts(height, tile_size, overlap)
+        tiles = [(row, col, x, y, min(width, x + tile_size), min(height, y + tile_size))
+                 for row, y in enumerate(ys) for col, x in enumerate(xs)]
+
+        with stage('index'):
+            index = GridIndex(tile_size)
+            for annotation in annotations:
+                if annotation.type in ('rectangle', 'polygon'):
+                    index.insert(annotation, annotation_bounds(annotation, width, height))
+
+        # 总览页
+        with stage('resize'):
+            overview = resize_image(full, QUALITY_PROFILES['preview'], MAX_DECODE_PIXELS)
+        ow, oh = overview.size
+        scale = ow / width
+        with stage('encode'):
+            overview_buffer = encode_jpeg(overview)
+        if overview is not full:
+            overview.close()
+        pdf_canvas.setPageSize((ow, oh))
+        pdf_canvas.bookmarkPage('overview')
+        pdf_canvas.addOutlineEntry('Overview', 'overview')
+        with stage('embed'):
+            pdf_canvas.drawImage(JPEGPassthroughReader(overview_buffer), 0, 0, width=ow, height=oh)
+        del overview_buffer
+        with stage('overlay'):
+            draw_annotations(pdf_canvas, annotations, palette, ow, oh)
+            pdf_canvas.setStrokeColor(palette.font)
+            pdf_canvas.setFillColor(palette.font)
+            pdf_canvas.setFont('DejaVuSans', 12)
+            for row, col, x0, y0, x1, y1 in tiles:
+                rect = (x0 * scale, oh - y1 * scale, x1 * scale, oh - y0 * scale)
+                pdf_canvas.rect(rect[0], rect[1], rect[2] - rect[0], rect[3] - rect[1], fill=0, stroke=1)
+                pdf_canvas.drawString(rect[0] + 4, rect[3] - 14, f"R{row + 1}C{col + 1}")
+                pdf_canvas.linkRect('', f"tile_{row}_{col}", rect)
+        pdf_canvas.showPage()
+
+        # 分块页：页面坐标 = 原图坐标平移 (-x0, -(height - y1))
+        for row, col, x0, y0, x1, y1 in tiles:
+            with stage('encode'):
+                tile = full.crop((x0, y0, x1, y1))
+                tile_buffer = encode_jpeg(tile)
+                tile.close()
+            tw, th = x1 - x0, y1 - y0
+            pdf_canvas.setPageSize((tw, th))
+            key = f"tile_{row}_{col}"
+            pdf_canvas.bookmarkPage(key)
+            pdf_canvas.addOutlineEntry(f"R{row + 1}C{col + 1} ({x0},{y0})–({x1},{y1})", key)
+            with stage('embed'):
+                pdf_canvas.drawImage(JPEGPassthroughReader(tile_buffer), 0, 0, width=tw, height=th)
+            del tile_buffer
+            with stage('overlay'):
+                pdf_canvas.saveState()
+                pdf_canvas.translate(-x0, -(height - y1))
+                draw_annotations(pdf_canvas, annotations, palette, width, height,
+                                 only=index.query((x0, y0, x1, y1)))
+                pdf_canvas.restoreState()
+            pdf_canvas.showPage()
+        full.close()
+
+    RENDER_ANNOTATIONS.observe(len(annotations))
+    RENDER_MEGAPIXELS.observe(width * height / 1e6)
+    record_info('annotations', len(annotations))
+    record_info('image', f"{width}x{height}")
+    record_info('tiles', len(tiles))
+    with stage('save'), _font_subset_lock:
+        pdf_canvas.save()
+
+
+# -------------------------------
+# 渲染准入控制
+# -------------------------------
+
+# 同时渲染的任务数（默认 CPU 核数）与渲染中间数据的内存预算（字节，默认 2 GiB），
+# 整机共享：同一 cache_dir 下的所有 worker 进程与导出任务进程合计
+RENDER_SLOTS = int(os.getenv('render_slots', str(os.cpu_count() or 1)))
+RENDER_MEMORY_BUDGET = int(os.getenv('render_memory_budget', str(2 * 1024 ** 3)))
+# 请求排队等待渲染的最长秒数，超时返回 429
+RENDER_QUEUE_SECONDS = float(os.getenv('render_queue_seconds', '10'))
+# 每个标注在绘制时的估算内存开销（字节）
+ANNOTATION_COST_BYTES = 4096
+
+ADMISSION_REJECTED_TOTAL = Counter('label_to_pdf_admission_rejected_total', '排队超时被拒绝的渲染数')
+ADMISSION_WAIT_SECONDS = Histogram('label_to_pdf_admission_wait_seconds', '渲染排队等待时间')
+
+
+def estimate_render_cost(image, annotation_count: int, max_dimension=MAX_DIMENSION,
+                         max_pixels=MAX_DECODE_PIXELS) -> int:
+    """
+    估算一页渲染的峰值内存（字节），同图多页时 annotation_count 为各页标注数之和。
+    原始字节只读文件头取尺寸，不解码：
+    可原样嵌入的 JPEG 只计压缩数据；需要解码的按 RGB 计解码图与缩小后的图
+    （JPEG draft 解码最多是目标尺寸的 4 倍像素）。
+    """
+    if isinstance(image, (bytes, bytearray)):
+        header = Image.open(BytesIO(image))
+        cost = len(image) * 2
+        if not can_passthrough(header, max_dimension, max_pixels):
+            target_w, target_h = fit_image_size(header.size, max_dimension, max_pixels)
+            decoded = header.width * header.height
+            if header.format == 'JPEG':
+                decoded = min(decoded, 4 * target_w * target_h)
+            cost += (decoded + target_w * target_h) * 3
+    else:
+        cost = image.width * image.height * 3 * 2
+    return cost + annotation_count * ANNOTATION_COST_BYTES
+
+
+# 不传 timeout 时 admit() 使用的等待时长，由 admission_timeout() 在当前上下文中设置
+_admission_timeout = ContextVar('admission_timeout', default=...)
+
+
+@contextmanager
+def admission_timeout(seconds):
+    """
+    在当前上下文（含 submit_with_context 提交的工作线程）中改变渲染排队的最长等待秒数，None 为一直等。
+    用于后台导出、预渲染与离线渲染：已经开始的批量工作不应因排队超时中途失败。
+    """
+    token = _admission_timeout.set(seconds)
+    try:
+        yield
+    finally:
+        _admission_timeout.reset(token)
+
+
+class AdmissionController:
+    """
+    渲染准入：同时进行的渲染数不超过 slots，估算内存之和不超过 budget。
+    额度整机共享：登记保存在 path 指向的 JSON 文件中，读写时持有 flock，
+    gunicorn 的各 worker 与导出任务进程都通过同一个文件排队。
+    放不下时排队等待（按登记顺序先到先得），超过 timeout 抛出 RenderRejectedError；timeout 为 None 时一直等。
+    单个超过整个预算的任务在空闲时也允许运行（是否能解码由 MAX_DECODE_PIXELS 决定）。
+    进程异常退出遗留的登记在下次读写时按 PID 清理。
+    """
+    POLL_SECONDS = 0.01
+    MAX_POLL_SECONDS = 0.1
+    # 登记号 = PID + 进程内序号（所有实例共用，同一进程内的多个实例也不会重号）
+    _seq = itertools.count()
+
+    def __init__(self, path: str, slots: int, budget: int, timeout):
+        self.path = path
+        self.slots = slots
+        self.budget = budget
+        self.timeout = timeout
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    @contextmanager
+    def _state(self):
+        """持有文件锁读出 {"running": [...], "queue": [...]}（元素为 [登记号, PID, 估算字节]），退出时写回。"""
+        with open(self.path, 'a+', encoding='utf-8') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    state = json.loads(f.read() or '{}')
+                    state.setdefault('running', [])
+                    state.setdefault('queue', [])
+                except ValueError:
+                    state = {'running': [], 'queue': []}
+                alive = {}
+                for entries in (state['running'], state['queue']):
+                    entries[:] = [e for e in entries if alive.setdefault(e[1], _pid_alive(e[1]))]
+                yield state
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _fits(self, running: list, cost: int) -> bool:
+        return len(running) < self.slots and (not running or sum(e[2] for e in running) + cost <= self.budget)
+
+    @contextmanager
+    def admit(self, cost: int, timeout=...):
+        """
+        排队直到放得下 cost 字节的渲染。timeout 不传时取 admission_timeout() 设置的值，
+        未设置则为构造时的 timeout。
+        """
+        if timeout is ...:
+            timeout = _admission_timeout.get()
+        if timeout is ...:
+            timeout = self.timeout
+        cost = min(cost, self.budget)
+        entry = [f"{os.getpid()}-{next(self._seq)}", os.getpid(), cost]
+        start = time.perf_counter()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = self.POLL_SECONDS
+        admitted = False
+        with self._state() as state:
+            state['queue'].append(entry)
+        try:
+            while True:
+                rejected = None
+                with self._state() as state:
+                    queue, running = state['queue'], state['running']
+                    if queue and queue[0][0] == entry[0] and self._fits(running, cost):
+                        running.append(queue.pop(0))
+                        admitted = True
+                        break
+                    if deadline is not None and time.monotonic() >= deadline:
+                        rejected = (len(running), len(queue) - 1)
+                if rejected is not None:
+                    ADMISSION_REJECTED_TOTAL.inc()
+                    raise RenderRejectedError(
+                        f"渲染排队已满（{rejected[0]} 个进行中，{rejected[1]} 个排队），请稍后重试",
+                        retry_after=max(1, math.ceil(timeout)))
+                remaining = None if deadline is None else deadline - time.monotonic()
+                time.sleep(delay if remaining is None else max(0, min(delay, remaining)))
+                delay = min(delay * 2, self.MAX_POLL_SECONDS)
+        finally:
+            if not admitted:
+                with self._state() as state:
+                    state['queue'] = [e for e in state['queue'] if e[0] != entry[0]]
+        ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - start)
+        try:
+            yield
+        finally:
+            with self._state() as state:
+                state['running'] = [e for e in state['running'] if e[0] != entry[0]]
+
+    def stats(self) -> dict:
+        with self._state() as state:
+            return {"running": len(state['running']), "queued": len(state['queue']),
+                    "reserved_bytes": sum(e[2] for e in state['running']),
+                    "slots": self.slots, "budget_bytes": self.budget}
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+_admission = AdmissionController(os.path.join(CACHE_DIR, 'admission.json'), RENDER_SLOTS, RENDER_MEMORY_BUDGET,
+                                 RENDER_QUEUE_SECONDS)
+
+# -------------------------------
+# Label Studio 数据拉取
+# -------------------------------
+
+# 批量导出时并发拉取任务/图像的线程数
+EXPORT_MAX_WORKERS = int(os.getenv('export_max_workers', '8'))
+# 任务列表分页大小
+EXPORT_PAGE_SIZE = int(os.getenv('export_page_size', '100'))
+
+
+# Label Studio 请求超时（秒）：(连接, 读取)，防止一个慢请求无限期占住 gunicorn worker
+LS_TIMEOUT = (float(os.getenv('ls_connect_timeout', '3.05')), float(os.getenv('ls_read_timeout', '30')))
+# 5xx / 连接被重置时的重试次数与退避系数
+LS_MAX_RETRIES = int(os.getenv('ls_max_retries', '3'))
+LS_RETRY_BACKOFF = float(os.getenv('ls_retry_backoff', '0.3'))
+# 每个进程到 Label Studio 的最大保活连接数
+LS_POOL_SIZE = int(os.getenv('ls_pool_size', '16'))
+
+_session = None
+_fetch_pool = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def ls_headers() -> dict:
+    if not LABEL_STUDIO_TOKEN:
+        raise RuntimeError("请先配置环境变量：label_studio_api_token")
+    return {'Authorization': f"Token {LABEL_STUDIO_TOKEN}"}
+
+
+def _ensure_client():
+    """
+    每个 worker 进程懒加载一个带连接池的 Session 和一个拉取线程池。
+    按 pid 判断，fork 之后在子进程中重建，不与父进程共享 socket。
+    """
+    global _session, _fetch_pool, _client_pid
+    pid = os.getpid()
+    if _client_pid == pid:
+        return
+    with _client_lock:
+        if _client_pid == pid:
+            return
+        retry = Retry(
+            total=LS_MAX_RETRIES,
+            backoff_factor=LS_RETRY_BACKOFF,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset({'GET', 'HEAD'}),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=LS_POOL_SIZE, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update(ls_headers())
+        _session = session
+        _fetch_pool = ThreadPoolExecutor(max_workers=LS_POOL_SIZE, thread_name_prefix='ls-fetch')
+        _client_pid = pid
+
+
+def ls_get(path: str, **kwargs) -> requests.Response:
+    """
+    通过共享 Session 请求 Label Studio（连接复用、自动重试、默认超时）。
+    """
+    _ensure_client()
+    kwargs.setdefault('timeout', LS_TIMEOUT)
+    return _session.get(f"{LABEL_STUDIO_HOST}{path}", **kwargs)
+
+
+def ls_submit(fn, *args):
+    """
+    把互不依赖的上游请求丢到拉取线程池中并发执行，返回 Future。
+    """
+    _ensure_client()
+    return submit_with_context(_fetch_pool, fn, *args)
+
+
+def fetch_task(task_id) -> dict:
+    with stage('fetch_task'):
+        resp = ls_get(f"/api/tasks/{task_id}")
+        resp.raise_for_status()
+        return resp.json()
+
+
+def fetch_image(ocr: str) -> bytes:
+    """
+    拉取 OCR 原图。原图不会变化，优先读本地磁盘缓存，未命中才走网络并写回缓存。
+    """
+    with stage('fetch_image'):
+        data = _image_cache.get(ocr)
+        record_info('image_cache', 'hit' if data is not None else 'miss')
+        if data is not None:
+            return data
+        resp = ls_get(ocr)
+        resp.raise_for_status()
+        data = resp.content
+        _image_cache.set(ocr, data)
+        return data
+
+
+def list_project_tasks(project_id) -> list:
+    """
+    分页列出项目下全部任务的 (ID, updated_at)，列表接口不带 updated_at 时为 None。
+    兼容新版接口返回 {"tasks": [...], "total": n} 与旧版直接返回列表两种格式。
+    """
+    task_ids, page = [], 1
+    while True:
+        resp = ls_get('/api/tasks', params={'project': project_id, 'page': page, 'page_size': EXPORT_PAGE_SIZE})
+        # 越过最后一页时 Label Studio 返回 404
+        if resp.status_code == 404 and page > 1:
+            break
+        resp.raise_for_status()
+        body = resp.json()
+        tasks = body.get('tasks', []) if isinstance(body, dict) else body
+        task_ids.extend((t['id'], t.get('updated_at')) for t in tasks)
+        total = body.get('total') if isinstance(body, dict) else None
+        if len(tasks) < EXPORT_PAGE_SIZE or (total is not None and len(task_ids) >= total):
+            break
+        page += 1
+    return task_ids
+
+
+def build_color_map(project_json: dict) -> dict:
+    """
+    从项目配置中提取 标签 -> 背景色 映射。
+    """
+    labels_attrs = project_json.get('parsed_label_config', {}).get('label', {}).get('labels_attrs', {})
+    return {lbl: attrs.get('background', '#00ff00') for lbl, attrs in labels_attrs.items()}
+
+
+def color_map_from_label_config(xml_text: str) -> dict:
+    """
+    从标签配置 XML 中提取 标签 -> 背景色 映射，与 build_color_map 一致只取 name="label" 的控件；
+    没有该控件时取全部 <Label>。
+    """
+    from xml.etree import ElementTree
+    root = ElementTree.fromstring(xml_text)
+    controls = [el for el in root.iter() if el.get('name') == 'label'] or [root]
+    return {lbl.get('value'): lbl.get('background', '#00ff00')
+            for control in controls for lbl in control.iter('Label') if lbl.get('value')}
+
+
+def format_sydney_time(updated) -> str:
+    """
+    将 ISO 时间转换为悉尼时间字符串，失败时原样返回。
+    """
+    try:
+        dt = parser.isoparse(updated)
+        if dt.tzinfo is None: dt = dt.replace(tzinfo=tz.tzutc())
+        return dt.astimezone(SYDNEY_TZ).strftime('%Y-%m-%d %H:%M:%S')
+    except Exception:
+        return updated
+
+
+def parse_http_time(updated):
+    """
+    将 ISO 时间解析为带时区的 datetime（用作 Last-Modified），失败返回 None。
+    """
+    try:
+        dt = parser.isoparse(updated)
+    except Exception:
+        return None
+    if dt.tzinfo is None: dt = dt.replace(tzinfo=tz.tzutc())
+    return dt.replace(microsecond=0)
+
+
+def get_quality_arg():
+    """
+    读取 ?quality=preview|standard|full，返回 (档位, 长边上限)；非法取值抛 ValueError。
+    """
+    quality = request.args.get('quality', DEFAULT_QUALITY).lower()
+    if quality not in QUALITY_PROFILES:
+        raise ValueError(f"quality 仅支持 {'|'.join(QUALITY_PROFILES)}")
+    return quality, QUALITY_PROFILES[quality]
+
+
+def load_task_for_render(task_id):
+    """
+    拉取单个任务的 JSON 与 OCR 图像并解析标注，供批量导出的线程池调用。
+    返回 (task_json, image_bytes, annotations)；任务没有 data['ocr'] 时 image_bytes 为 None。
+    """
+    td = fetch_task(task_id)
+    ocr = td.get('data', {}).get('ocr')
+    if not ocr:
+        return td, None, None
+    image = fetch_image(ocr)
+    return td, image, load_annotations(td)
+
+
+def capture_errors(fn):
+    """
+    包装批量导出的单任务函数：返回 (结果, None) 或 (None, 异常)，
+    单个任务拉取或渲染失败不会从 iter_bounded 抛出而中断整个导出。
+    """
+    def wrapper(item):
+        try:
+            return fn(item), None
+        except Exception as e:
+            return None, e
+    return wrapper
+
+
+def task_failure(task_id, error: Exception) -> dict:
+    """记录单个任务的失败，返回写入清单 / 任务状态的条目。"""
+    app.logger.warning("导出任务 %s 失败：%s: %s", task_id, type(error).__name__, error)
+    return {"id": task_id, "error": f"{type(error).__name__}: {error}"}
+
+
+def iter_bounded(executor, fn, items, window: int):
+    """
+    按 items 顺序产出 fn(item) 的结果，同时最多保持 window 个任务在途，
+    避免整个项目的解码图像同时驻留内存。
+    """
+    pending = deque()
+    items = iter(items)
+    for item in items:
+        pending.append(submit_with_context(executor, fn, item))
+        if len(pending) >= window:
+            break
+    while pending:
+        yield pending.popleft().result()
+        for item in items:
+            pending.append(submit_with_context(executor, fn, item))
+            break
+
+def task_pdf_title(title: str, task_id, updated) -> str:
+    return f"{title}(unit-converted) / Task ID: {task_id} / Last Modified (Sydney Time): {format_sydney_time(updated)}"
+
+
+def spool_file():
+    """PDF 输出缓冲：小文件留在内存，超过 SPOOL_MAX_MEMORY 自动落盘，单个请求的内存占用有上限。"""
+    return tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+
+
+def render_task_pdf(td: dict, meta, max_dimension=MAX_DIMENSION, layout='page', selector=None):
+    """
+    渲染单个任务（调用方已确认 data['ocr'] 存在），返回已回到开头的 spool_file()。
+    layout 为 page 时单页输出（长边受 max_dimension 限制），为 tiled 时按原始分辨率分块输出。
+    selector 给出时（'all' 或标注 ID 列表，见 select_annotations）每份标注一页，图像只解码一次。
+    """
+    output = spool_file()
+    title = task_pdf_title(meta.title, td.get('id'), td.get('updated_at'))
+    if selector is not None:
+        variants = [(annotation_header(a), load_annotations(td, a)) for a in select_annotations(td, selector)]
+        annotate_image_variants_to_pdf(fetch_image(td['data']['ocr']), variants, output, meta.palette,
+                                       title, max_dimension)
+    elif layout == 'tiled':
+        annotate_image_to_tiled_pdf(fetch_image(td['data']['ocr']), load_annotations(td), output, meta.palette, title)
+    else:
+        annotate_image_to_pdf(fetch_image(td['data']['ocr']), load_annotations(td), output, meta.palette,
+                              title, max_dimension)
+    output.seek(0)
+    return output
+
+
+def render_task_cached(project_id, td: dict, meta, quality: str, max_dimension=MAX_DIMENSION, layout='page',
+                       selector=None):
+    """
+    取已缓存的任务 PDF，未命中则渲染并写入缓存（layout、selector 见 render_task_pdf）。
+    返回 (cache_key, source)：source 为缓存文件路径；PDF 超出缓存上限写不进去时为 spool_file()。
+    同一 PDF 的并发渲染会被合并：进程内用 _render_flight，跨 worker 进程用缓存目录上的文件锁。
+    """
+    cache_key = pdf_cache_key(project_id, td.get('id'), td.get('updated_at'), meta,
+                              layout_cache_tag(quality, layout, selector))
+    cached_path = _pdf_cache.path(cache_key)
+    if cached_path is not None:
+        return cache_key, cached_path
+    source, shared = _render_flight.do(cache_key, _render_locked, cache_key, td, meta, max_dimension, layout,
+                                       selector)
+    if shared and not isinstance(source, str):
+        # 放不进缓存的 PDF 只有一个文件句柄，不能多个请求同时读，各自重新渲染
+        source = render_task_pdf(td, meta, max_dimension, layout, selector)
+    return cache_key, source
+
+
+def layout_cache_tag(quality: str, layout='page', selector=None) -> str:
+    """缓存键中的输出档位：单页为质量档位，分块为分块参数（与质量档位无关），多份标注时附加所选标注。"""
+    tag = quality if layout == 'page' else f"tiled-{TILE_SIZE}-{TILE_OVERLAP}"
+    if selector is not None:
+        tag += '+annotations=' + (selector if selector == 'all' else ','.join(str(i) for i in selector))
+    return tag
+
+
+def _render_locked(cache_key: str, td: dict, meta, max_dimension, layout, selector):
+    with _pdf_cache.lock(cache_key):
+        # 等锁期间其他进程可能已经渲染好
+        cached_path = _pdf_cache.path(cache_key)
+        if cached_path is not None:
+            COALESCED_TOTAL.inc('render')
+            return cached_path
+        output = render_task_pdf(td, meta, max_dimension, layout, selector)
+        _pdf_cache.set_file(cache_key, output)
+    cached_path = _pdf_cache.path(cache_key)
+    if cached_path is not None:
+        output.close()
+        return cached_path
+    output.seek(0)
+    return output
+
+
+_render_flight = SingleFlight('render')
+
+
+def export_tasks(project_id, meta, tasks: list, out_format: str, output, quality=DEFAULT_QUALITY,
+                 progress=None, previous=None, delta=False):
+    """
+    批量渲染 tasks 写入 output（可写的二进制文件对象），tasks 的元素为任务 ID 或 (ID, updated_at)。
+      - pdf：所有任务合并为一个多页 PDF（每个任务一页，带书签）
+      - zip：每个任务一个 PDF，打包为 ZIP，并附带 manifest.json（见 export_zip）
+    progress(done, total) 在每个任务完成后回调。
+    单个任务拉取或渲染失败时记录后继续导出其余任务；没有任何任务导出成功时抛出第一个失败的异常。
+    返回 (缺少 data['ocr'] 而被跳过的任务 ID, 失败的任务 [{"id", "error"}], manifest)，pdf 格式的 manifest 为 None。
+    """
+    items = [t if isinstance(t, tuple) else (t, None) for t in tasks]
+    # 导出已经开始后逐个任务排队，不能因某个任务排队超时让整个导出中途失败
+    with admission_timeout(None):
+        if out_format == 'zip':
+            manifest = export_zip(project_id, meta, items, output, quality, progress, previous, delta)
+            return manifest['skipped'], manifest['failed'], manifest
+
+        max_dimension = QUALITY_PROFILES[quality]
+        skipped, failed, first_error, done = [], [], None, 0
+        with ThreadPoolExecutor(max_workers=EXPORT_MAX_WORKERS) as executor:
+            pdf_canvas = canvas.Canvas(output, pageCompression=True)
+            pdf_canvas.setTitle(f"{meta.title}(unit-converted) / Project ID: {project_id} / Tasks: {len(items)}")
+            task_ids = [task_id for task_id, _ in items]
+            results = iter_bounded(executor, capture_errors(load_task_for_render), task_ids, EXPORT_MAX_WORKERS * 2)
+            for task_id, (loaded, error) in zip(task_ids, results):
+                done += 1
+                if error is None:
+                    td, image, annotations = loaded
+                    if image is None:
+                        skipped.append(td.get('id'))
+                    else:
+                        ts = format_sydney_time(td.get('updated_at'))
+                        bookmark = (f"task_{td.get('id')}", f"Task ID: {td.get('id')} / {ts}")
+                        try:
+                            draw_annotated_page(pdf_canvas, image, annotations, meta.palette, max_dimension, bookmark)
+                        except Exception as e:
+                            error = e
+                if error is not None:
+                    failed.append(task_failure(task_id, error))
+                    first_error = first_error or error
+                if progress: progress(done, len(items))
+            if failed and len(skipped) + len(failed) == len(items):
+                raise first_error
+            with stage('save'), _font_subset_lock:
+                pdf_canvas.save()
+        return skipped, failed, None
+
+
+def export_zip(project_id, meta, items: list, output, quality=DEFAULT_QUALITY, progress=None,
+               previous=None, delta=False) -> dict:
+    """
+    每个任务一个 PDF 打包为 ZIP，返回写入 manifest.json 的清单：
+      {"project", "quality", "renderer", "style", "generated_at", "delta", "skipped", "failed", "removed",
+       "tasks": {"<任务 ID>": {"updated_at", "sha256", "size", "file"}}}
+    列表接口已给出 updated_at 且 PDF 缓存命中的任务不再拉取任务 JSON。
+    单个任务失败时记入 failed（[{"id", "error"}]）并继续，不写入 tasks，下次增量导出会重新渲染；
+    没有任何任务导出成功时抛出第一个失败的异常。
+    previous 为上一次导出的清单；渲染器版本、项目样式与质量档位都一致时才沿用：
+    delta=True 时 ZIP 只包含新增或 updated_at 变化的任务，未变化的任务只在清单中保留原条目，
+    removed 列出上次有、本次已不存在的任务。
+    """
+    max_dimension = QUALITY_PROFILES[quality]
+    base = {}
+    if (isinstance(previous, dict) and isinstance(previous.get('tasks'), dict)
+            and previous.get('renderer') == RENDERER_VERSION and previous.get('style') == meta.style_hash
+            and previous.get('quality') == quality and str(previous.get('project')) == str(project_id)):
+        base = previous['tasks']
+    delta = bool(delta and base)
+
+    def unchanged(task_id, updated_at):
+        entry = base.get(str(task_id))
+        return delta and updated_at is not None and entry is not None and entry.get('updated_at') == updated_at
+
+    def export_one(item):
+        """返回 (任务 ID, updated_at, PDF 文件对象 | None, 沿用的清单条目 | None)。"""
+        task_id, updated_at = item
+        if unchanged(task_id, updated_at):
+            return task_id, updated_at, None, base[str(task_id)]
+        if updated_at is not None:
+            cached = _pdf_cache.open(pdf_cache_key(project_id, task_id, updated_at, meta, quality))
+            if cached is not None:
+                return task_id, updated_at, cached, None
+        td = fetch_task(task_id)
+        updated_at = td.get('updated_at')
+        if unchanged(task_id, updated_at):
+            return task_id, updated_at, None, base[str(task_id)]
+        if not td.get('data', {}).get('ocr'):
+            return task_id, updated_at, None, None
+        _, source = render_task_cached(project_id, td, meta, quality, max_dimension)
+        return task_id, updated_at, open(source, 'rb') if isinstance(source, str) else source, None
+
+    manifest = {"project": str(project_id), "quality": quality, "renderer": RENDERER_VERSION,
+                "style": meta.style_hash, "generated_at": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                "delta": delta, "skipped": [], "failed": [], "removed": [], "tasks": {}}
+    done, first_error = 0, None
+    with ThreadPoolExecutor(max_workers=EXPORT_MAX_WORKERS) as executor, \
+            zipfile.ZipFile(output, 'w', zipfile.ZIP_STORED) as zf:
+        results = iter_bounded(executor, capture_errors(export_one), items, EXPORT_MAX_WORKERS * 2)
+        for (task_id, _), (exported, error) in zip(items, results):
+            done += 1
+            task_id, updated_at, pdf_file, entry = exported or (task_id, None, None, None)
+            if error is not None:
+                manifest['failed'].append(task_failure(task_id, error))
+                first_error = first_error or error
+            elif entry is not None:
+                manifest['tasks'][str(task_id)] = entry
+            elif pdf_file is None:
+                manifest['skipped'].append(task_id)
+            else:
+                name = f"task_{task_id}.pdf"
+                digest, size = hashlib.sha256(), 0
+                with pdf_file, zf.open(name, 'w') as zentry:
+                    while True:
+                        chunk = pdf_file.read(STREAM_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        digest.update(chunk)
+                        zentry.write(chunk)
+                        size += len(chunk)
+                manifest['tasks'][str(task_id)] = {"updated_at": updated_at, "sha256": digest.hexdigest(),
+                                                   "size": size, "file": name}
+            if progress: progress(done, len(items))
+        if manifest['failed'] and len(manifest['skipped']) + len(manifest['failed']) == len(items):
+            raise first_error
+        current = {str(task_id) for task_id, _ in items}
+        manifest['removed'] = sorted((k for k in base if k not in current), key=lambda k: (len(k), k))
+        zf.writestr('manifest.json', json.dumps(manifest, ensure_ascii=False, indent=1))
+    return manifest
+
+# -------------------------------
+# 磁盘缓存
+# -------------------------------
+
+# 原图缓存字节上限（默认 2 GiB）
+IMAGE_CACHE_MAX_BYTES = int(os.getenv('image_cache_max_bytes', str(2 * 1024 ** 3)))
+# 已渲染 PDF 缓存字节上限（默认 1 GiB）；不带 delta 的整项目重新导出要全部命中，须大于项目 PDF 总量
+PDF_CACHE_MAX_BYTES = int(os.getenv('pdf_cache_max_bytes', str(1024 ** 3)))
+
+
+class DiskLRUCache:
+    """
+    以文件保存的字节缓存，按最近使用顺序淘汰，整个目录的总大小受 max_bytes 限制。
+    文件名为 key 的 sha256，写入先落临时文件再 rename，多个 worker / 渲染进程可共享同一目录：
+    目录总字节数保存在目录下的 .state 中，写入、删除与淘汰都在它的 flock 内进行并更新总数，
+    因此预算对共享目录的所有进程合计生效，而不是每个进程各占一份。
+    淘汰顺序来自本进程的内存索引；其他进程写入的文件只在启动时、索引中的文件已被其他进程删除、
+    或本进程的条目全部删完仍超预算时合并进索引（见 _rescan，按 mtime 排序，命中时会刷新 mtime）。
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = self.misses = self.evictions = 0
+        self._index = OrderedDict()   # 文件名 -> 字节数，按最近使用排序
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # 启动时按磁盘实际大小校正共享总数（之前有进程在更新总数前异常退出时会有偏差）
+        with self._shared() as shared:
+            self._rescan()
+            shared['bytes'] = sum(self._index.values())
+
+    @contextmanager
+    def _shared(self):
+        """持有目录级文件锁读出 {"bytes": 目录总字节数}，退出时写回。"""
+        with open(os.path.join(self.directory, '.state'), 'a+', encoding='utf-8') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    shared = json.loads(f.read() or '{}')
+                except ValueError:
+                    shared = {}
+                if not isinstance(shared.get('bytes'), int):
+                    self._rescan()
+                    shared = {'bytes': sum(self._index.values())}
+                yield shared
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(shared))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _rescan(self):
+        """
+        把磁盘上的文件合并进索引：已在索引中的保持原有的最近使用顺序，
+        索引中没有的（启动前或其他进程写入的）按 mtime 排在最前，磁盘上已不存在的移除。
+        调用方需持有锁或处于初始化阶段。
+        """
+        found, unknown = {}, []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.startswith('.'):
+                st = entry.stat()
+                found[entry.name] = st.st_size
+                if entry.name not in self._index:
+                    unknown.append((st.st_mtime, entry.name))
+        unknown.sort()
+        index = OrderedDict((name, found[name]) for _, name in unknown)
+        for name in self._index:
+            if name in found:
+                index[name] = found[name]
+        self._index = index
+
+    def _name(self, key: str) -> str:
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def path(self, key: str):
+        """
+        命中时返回缓存文件路径（并刷新其最近使用时间），否则返回 None。
+        """
+        name = self._name(key)
+        path = os.path.join(self.directory, name)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+                # 被其他进程删除或淘汰，共享总数已由它扣除
+                self._index.pop(name, None)
+            return None
+        with self._lock:
+            self.hits += 1
+            if name in self._index:
+                self._index.move_to_end(name)
+            else:
+                self._index[name] = os.path.getsize(path)
+        return path
+
+    @contextmanager
+    def lock(self, key: str):
+        """
+        跨进程互斥（flock），用于多个 worker 同时未命中同一 key 时只生成一次。
+        按文件名前两位分成 256 把锁文件，锁文件数量有上限；以 . 开头，不计入缓存。
+        """
+        lock_path = os.path.join(self.directory, f".lock-{self._name(key)[:2]}")
+        with open(lock_path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def open(self, key: str):
+        """命中时返回以二进制只读打开的缓存文件，否则返回 None。"""
+        path = self.path(key)
+        if path is None:
+            return None
+        try:
+            return open(path, 'rb')
+        except FileNotFoundError:
+            # 刚好被其他进程淘汰
+            return None
+
+    def get(self, key: str):
+        path = self.path(key)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            # 刚好被其他进程淘汰
+            return None
+
+    def set(self, key: str, data: bytes):
+        self.set_file(key, BytesIO(data))
+
+    def set_file(self, key: str, fileobj):
+        """从文件对象的当前位置分块复制到缓存，不需要先把内容整体读进内存。"""
+        start = fileobj.tell()
+        size = fileobj.seek(0, os.SEEK_END) - start
+        fileobj.seek(start)
+        if size > self.max_bytes:
+            return
+        name = self._name(key)
+        path = os.path.join(self.directory, name)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(fileobj, f, STREAM_CHUNK_SIZE)
+            with self._lock, self._shared() as shared:
+                shared['bytes'] += size - (self._unlink(path, replace_with=tmp_path) or 0)
+                self._index.pop(name, None)
+                self._index[name] = size
+                if shared['bytes'] > self.max_bytes:
+                    self._evict(shared)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def delete(self, key: str):
+        name = self._name(key)
+        with self._lock, self._shared() as shared:
+            self._index.pop(name, None)
+            shared['bytes'] -= self._unlink(os.path.join(self.directory, name)) or 0
+
+    def clear(self):
+        with self._lock, self._shared() as shared:
+            self._rescan()
+            while self._index:
+                name, _ = self._index.popitem(last=False)
+                self._unlink(os.path.join(self.directory, name))
+                self.evictions += 1
+            shared['bytes'] = 0
+
+    def _unlink(self, path: str, replace_with: str = None):
+        """删除（或用 replace_with 替换）path，返回原文件的字节数，原本不存在时返回 None。调用方需持有 _shared()。"""
+        try:
+            size = os.stat(path).st_size
+        except FileNotFoundError:
+            size = None
+        if replace_with is not None:
+            os.replace(replace_with, path)
+            return size
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            # 缓存之外的清理（如 tmp 清理任务）删掉的
+            return None
+        return size
+
+    def _evict(self, shared: dict):
+        if self._drop_oldest(shared) or shared['bytes'] > self.max_bytes:
+            # 索引与磁盘不一致（有文件已被其他进程淘汰），或本进程的条目删完仍超预算（其余是其他进程写入的），
+            # 合并一次磁盘状态、按实际大小校正总数后再按预算淘汰
+            self._rescan()
+            shared['bytes'] = sum(self._index.values())
+            self._drop_oldest(shared)
+
+    def _drop_oldest(self, shared: dict) -> bool:
+        """按最近使用顺序删除最旧的条目直到目录总大小不超预算，返回是否遇到已不存在的文件。"""
+        missing = False
+        while shared['bytes'] > self.max_bytes and self._index:
+            name, _ = self._index.popitem(last=False)
+            size = self._unlink(os.path.join(self.directory, name))
+            if size is None:
+                missing = True
+                continue
+            shared['bytes'] -= size
+            self.evictions += 1
+        return missing
+
+    def stats(self) -> dict:
+        with self._lock, self._shared() as shared:
+            return {
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": len(self._index), "bytes": shared['bytes'], "max_bytes": self.max_bytes
+            }
+
+
+_image_cache = DiskLRUCache(os.path.join(CACHE_DIR, 'images'), IMAGE_CACHE_MAX_BYTES)
+_pdf_cache = DiskLRUCache(os.path.join(CACHE_DIR, 'pdfs'), PDF_CACHE_MAX_BYTES)
+
+
+def pdf_cache_key(project_id, task_id, updated_at, meta, quality=DEFAULT_QUALITY) -> str:
+    """
+    已渲染 PDF 的缓存键：任务修改时间、项目标题/颜色配置、质量档位、渲染器版本任一变化都会换键。
+    """
+    return f"{project_id}:{task_id}:{updated_at}:{meta.style_hash}:{quality}:{RENDERER_VERSION}"
+
+
+def pdf_etag(cache_key: str) -> str:
+    return hashlib.sha256(cache_key.encode('utf-8')).hexdigest()[:32]
+
+# -------------------------------
+# 项目元数据缓存
+# -------------------------------
+
+# 项目标题/颜色映射的缓存有效期（秒）与最大项目数
+PROJECT_CACHE_TTL = float(os.getenv('project_cache_ttl', '300'))
+PROJECT_CACHE_SIZE = int(os.getenv('project_cache_size', '256'))
+# 跨进程的失效标记：POST /invalidate_cache 写入，各 worker / 渲染进程的 get_project_meta 据此丢弃自己的缓存
+INVALIDATION_DIR = os.path.join(CACHE_DIR, 'invalidated')
+
+
+class TTLCache:
+    """
+    线程安全的内存 LRU 缓存，条目带写入时间。
+    过期条目不会被立即丢弃，调用方可以拿它做条件请求重新验证。
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """返回 (value, stored_at)，不存在时返回 (None, 0)。"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None, 0
+            self._data.move_to_end(key)
+            return item
+
+    def set(self, key, value, stored_at: float = None):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() if stored_at is None else stored_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            return self._data.pop(key, None) is not None
+
+    def clear(self) -> int:
+        with self._lock:
+            n = len(self._data)
+            self._data.clear()
+            return n
+
+
+class ProjectMeta:
+    """
+    渲染所需的项目信息：标题、标签颜色映射，以及用于条件请求的 ETag / Last-Modified。
+    """
+    __slots__ = ('project_id', 'title', 'color_map', 'etag', 'last_modified', 'style_hash', 'palette')
+
+    def __init__(self, project_id, title, color_map, etag=None, last_modified=None):
+        self.project_id = project_id
+        self.title = title
+        self.color_map = color_map
+        self.etag = etag
+        self.last_modified = last_modified
+        # 标题与颜色配置的指纹，任一变化都会让已渲染的 PDF 失效
+        self.style_hash = hashlib.sha256(
+            json.dumps([title, color_map], sort_keys=True, ensure_ascii=False).encode('utf-8')
+        ).hexdigest()[:16]
+        # 调色板随项目元数据一起缓存
+        self.palette = get_style_palette(color_map)
+
+
+_project_cache = TTLCache(PROJECT_CACHE_SIZE)
+
+
+def _invalidation_path(project_id=None) -> str:
+    # 项目 ID 来自查询参数，取哈希作文件名，防止路径穿越
+    if project_id is None:
+        return os.path.join(INVALIDATION_DIR, 'all')
+    return os.path.join(INVALIDATION_DIR, hashlib.sha256(str(project_id).encode('utf-8')).hexdigest()[:32])
+
+
+def invalidation_marks(project_id) -> tuple:
+    """该项目当前的失效标记（整体失效与按项目失效），从未失效时为空串。"""
+    marks = []
+    for path in (_invalidation_path(), _invalidation_path(project_id)):
+        try:
+            with open(path, encoding='utf-8') as f:
+                marks.append(f.read())
+        except FileNotFoundError:
+            marks.append('')
+    return tuple(marks)
+
+
+def mark_invalidated(project_id=None):
+    """写入新的失效标记（先写临时文件再 rename），所有进程下次取该项目元数据时都会重新拉取。"""
+    os.makedirs(INVALIDATION_DIR, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=INVALIDATION_DIR, prefix='.mark-')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(os.urandom(8).hex())
+    os.replace(tmp, _invalidation_path(project_id))
+
+
+def get_project_meta(project_id) -> ProjectMeta:
+    """
+    获取项目元数据：有效期内直接命中缓存，不发请求；
+    过期后带 If-None-Match / If-Modified-Since 重新验证，304 时沿用旧值。
+    缓存之后项目被 /invalidate_cache 标记失效（可能由其他进程处理）时，不论是否过期都重新拉取。
+    """
+    key = str(project_id)
+    marks = invalidation_marks(key)
+    cached, stored_at = _project_cache.get(key)
+    meta = None
+    if cached is not None and cached[1] == marks:
+        meta = cached[0]
+        if time.monotonic() - stored_at < PROJECT_CACHE_TTL:
+            return meta
+
+    headers = {}
+    if meta is not None:
+        if meta.etag: headers['If-None-Match'] = meta.etag
+        if meta.last_modified: headers['If-Modified-Since'] = meta.last_modified
+    with stage('fetch_project'):
+        resp = ls_get(f"/api/projects/{project_id}", headers=headers)
+    if resp.status_code == 304 and meta is not None:
+        _project_cache.set(key, (meta, marks))
+        return meta
+    resp.raise_for_status()
+    pd = resp.json()
+    meta = ProjectMeta(
+        project_id=key,
+        title=pd.get('title', f'project_{project_id}'),
+        color_map=build_color_map(pd),
+        etag=resp.headers.get('ETag'),
+        last_modified=resp.headers.get('Last-Modified')
+    )
+    _project_cache.set(key, (meta, marks))
+    return meta
+
+# -------------------------------
+# 异步导出任务
+# -------------------------------
+
+# 后台渲染进程数（默认 CPU 核数）
+JOB_WORKERS = int(os.getenv('job_workers', str(os.cpu_count() or 1)))
+# 排队 + 运行中的任务上限（含 webhook 预渲染），超过时 POST /jobs 返回 429
+JOB_MAX_PENDING = int(os.getenv('job_max_pending', '32'))
+# 结果保留时长（秒，默认 24 小时），过期的任务目录在下次提交/查询时清理
+JOB_RETENTION_SECONDS = float(os.getenv('job_retention_seconds', str(24 * 3600)))
+# 任务状态与结果文件目录：<JOBS_DIR>/<job_id>/status.json、result
+JOBS_DIR = os.path.join(CACHE_DIR, 'jobs')
+
+_JOB_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+_job_pool = None
+_job_pool_pid = None
+_job_pending = set()   # 导出任务的 job_id 与预渲染的占位对象
+_job_lock = threading.Lock()
+
+
+def job_dir(job_id: str):
+    """job_id 合法时返回任务目录，否则返回 None（防止路径穿越）。"""
+    if not isinstance(job_id, str) or not _JOB_ID_RE.match(job_id):
+        return None
+    return os.path.join(JOBS_DIR, job_id)
+
+
+def read_job_status(job_id: str):
+    directory = job_dir(job_id)
+    if directory is None:
+        return None
+    try:
+        with open(os.path.join(directory, 'status.json'), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_job_status(job_id: str, **fields) -> dict:
+    """
+    合并写入任务状态。先写临时文件再 rename，轮询方不会读到半个 JSON。
+    同一任务的状态只由一个进程写入（提交方写 queued，之后由后台进程接管），无需跨进程加锁。
+    """
+    directory = job_dir(job_id)
+    status = read_job_status(job_id) or {}
+    status.update(fields)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.status-')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(status, f, ensure_ascii=False)
+    os.replace(tmp, os.path.join(directory, 'status.json'))
+    return status
+
+
+def run_export_job(job_id: str, project_id, task_ids, out_format: str, quality: str,
+                   previous=None, delta=False):
+    """
+    在后台进程中执行导出，进度与结果写入任务目录。task_ids 为 None 时导出整个项目。
+    单任务 PDF 与 /download 共用 PDF 缓存，输出完全相同；previous / delta 见 export_zip。
+    """
+    directory = job_dir(job_id)
+    # 后台进程只排队不拒绝
+    with admission_timeout(None):
+        write_job_status(job_id, state='running', started_at=time.time())
+        try:
+            max_dimension = QUALITY_PROFILES[quality]
+            meta = get_project_meta(project_id)
+            if task_ids is None:
+                task_ids = list_project_tasks(project_id)
+            if not task_ids:
+                raise ValueError("项目中没有任务")
+            write_job_status(job_id, progress={"done": 0, "total": len(task_ids)})
+            result_path = os.path.join(directory, 'result')
+            if out_format == 'pdf' and len(task_ids) == 1:
+                td = fetch_task(task_ids[0])
+                if not td.get('data', {}).get('ocr'):
+                    raise ValueError("Task JSON 中未找到 data['ocr']")
+                _, source = render_task_cached(project_id, td, meta, quality, max_dimension)
+                with open(result_path, 'wb') as f:
+                    if isinstance(source, str):
+                        with open(source, 'rb') as cached:
+                            shutil.copyfileobj(cached, f)
+                    else:
+                        with source:
+                            shutil.copyfileobj(source, f, STREAM_CHUNK_SIZE)
+                skipped, failed, filename = [], [], f"{meta.title}(unit-converted).pdf"
+            else:
+                last_report = [0.0]
+
+                def progress(done, total):
+                    # 最多每 0.5 秒落盘一次，避免大项目频繁写状态文件
+                    now = time.monotonic()
+                    if done == total or now - last_report[0] >= 0.5:
+                        last_report[0] = now
+                        write_job_status(job_id, progress={"done": done, "total": total})
+
+                with open(result_path, 'wb') as f:
+                    skipped, failed, _ = export_tasks(project_id, meta, task_ids, out_format, f, quality,
+                                                      progress, previous, delta)
+                if len(skipped) == len(task_ids):
+                    raise ValueError("所有任务均缺少 data['ocr']")
+                filename = f"{meta.title}(unit-converted).{out_format}"
+            write_job_status(job_id, state='done', finished_at=time.time(), skipped=skipped, failed=failed,
+                             progress={"done": len(task_ids), "total": len(task_ids)},
+                             filename=filename, size=os.path.getsize(result_path),
+                             mimetype='application/pdf' if out_format == 'pdf' else 'application/zip')
+        except Exception as e:
+            write_job_status(job_id, state='failed', finished_at=time.time(), error=f"{type(e).__name__}: {e}")
+
+
+def get_job_pool():
+    """每个进程一个渲染进程池；用 spawn 启动，避免在已有线程的进程里 fork。"""
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    global _job_pool, _job_pool_pid
+    if _job_pool is None or _job_pool_pid != os.getpid():
+        _job_pool = ProcessPoolExecutor(max_workers=JOB_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        _job_pool_pid = os.getpid()
+    return _job_pool
+
+
+def _job_finished(job_id: str, future):
+    with _job_lock:
+        _job_pending.discard(job_id)
+    # 正常情况下状态已由后台进程写好；进程崩溃（如被 OOM 杀掉）时在这里补记失败
+    exc = future.exception()
+    if exc is not None:
+        write_job_status(job_id, state='failed', finished_at=time.time(), error=f"{type(exc).__name__}: {exc}")
+
+
+def submit_to_job_pool(fn, *args):
+    """提交到渲染进程池；之前有子进程异常退出导致进程池不可用时，重建一次再提交。"""
+    from concurrent.futures.process import BrokenProcessPool
+    global _job_pool
+    try:
+        return get_job_pool().submit(fn, *args)
+    except BrokenProcessPool:
+        _job_pool = None
+        return get_job_pool().submit(fn, *args)
+
+
+def submit_export_job(project_id, task_ids, out_format: str, quality: str, previous=None, delta=False):
+    """
+    创建任务目录并提交到渲染进程池，返回 job_id；排队数已满时返回 None。
+    """
+    with _job_lock:
+        if len(_job_pending) >= JOB_MAX_PENDING:
+            return None
+        job_id = os.urandom(16).hex()
+        _job_pending.add(job_id)
+    os.makedirs(job_dir(job_id))
+    total = len(task_ids) if task_ids is not None else None
+    write_job_status(job_id, id=job_id, state='queued', created_at=time.time(), project=str(project_id),
+                     format=out_format, quality=quality, progress={"done": 0, "total": total})
+    try:
+        future = submit_to_job_pool(run_export_job, job_id, project_id, task_ids, out_format, quality,
+                                    previous, delta)
+    except Exception:
+        with _job_lock:
+            _job_pending.discard(job_id)
+        raise
+    future.add_done_callback(lambda f: _job_finished(job_id, f))
+    return job_id
+
+
+def sweep_jobs() -> int:
+    """删除超过保留时长的任务目录，返回删除数量。"""
+    removed = 0
+    cutoff = time.time() - JOB_RETENTION_SECONDS
+    try:
+        entries = list(os.scandir(JOBS_DIR))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        if not entry.is_dir() or not _JOB_ID_RE.match(entry.name):
+            continue
+        # 未结束的任务按创建时间计（服务重启后遗留的 queued/running 任务也会被清理）
+        status = read_job_status(entry.name) or {}
+        stamp = status.get('finished_at') or status.get('created_at') or entry.stat().st_mtime
+        if stamp >= cutoff:
+            continue
+        shutil.rmtree(entry.path, ignore_errors=True)
+        removed += 1
+    return removed
+
+# -------------------------------
+# Webhook 预渲染
+# -------------------------------
+
+# 同一任务连续编辑时，最后一次事件之后静默多少秒才开始渲染
+WEBHOOK_DEBOUNCE_SECONDS = float(os.getenv('webhook_debounce_seconds', '5'))
+# 预渲染的质量档位（逗号分隔）
+WEBHOOK_QUALITIES = [q.strip() for q in os.getenv('webhook_qualities', DEFAULT_QUALITY).split(',')
+                     if q.strip() in QUALITY_PROFILES]
+# 可选：Label Studio webhook 配置的自定义请求头 Authorization 须与之相同
+WEBHOOK_TOKEN = os.getenv('webhook_token')
+# 预渲染与导出任务共用进程池和排队上限；排队 + 运行中的任务达到此数时丢弃新的预渲染，
+# 默认只占 JOB_MAX_PENDING 的一半，批量标注时 POST /jobs 仍有空位
+WEBHOOK_MAX_PENDING = int(os.getenv('webhook_max_pending', str(max(1, JOB_MAX_PENDING // 2))))
+# 每个 worker 进程记住最近多少个任务的最新版本与预渲染结果（LRU）；
+# 超出后最久未收到事件的任务不再做乱序判断，其旧版本 PDF 交给 PDF 缓存按 LRU 淘汰
+WEBHOOK_TRACKED_TASKS = int(os.getenv('webhook_tracked_tasks', '4096'))
+
+PRERENDER_DROPPED_TOTAL = Counter('label_to_pdf_prerender_dropped_total', '进程池繁忙而丢弃的预渲染数')
+
+
+def prerender_task(project_id, task_id, quality: str):
+    """
+    在后台进程中渲染任务的当前版本并写入 PDF 缓存，返回缓存键；任务缺少图像时返回 None。
+    """
+    with admission_timeout(None):
+        meta = get_project_meta(project_id)
+        td = fetch_task(task_id)
+        if not td.get('data', {}).get('ocr'):
+            return None
+        cache_key, _ = render_task_cached(project_id, td, meta, quality, QUALITY_PROFILES[quality])
+        return cache_key
+
+
+class Debouncer:
+    """
+    按 key 合并短时间内的重复事件：最后一次 schedule 之后 delay 秒内无新事件，才以最新的 value 调用 callback。
+    所有 key 共用一个后台线程，突发大量任务时不会为每个任务各开一个 Timer 线程。
+    """
+
+    def __init__(self, delay: float, callback):
+        self.delay = delay
+        self.callback = callback
+        self._pending = {}   # key -> (到期时间, value)
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pid = None
+
+    def schedule(self, key, value):
+        with self._cond:
+            self._pending[key] = (time.monotonic() + self.delay, value)
+            # gunicorn 预加载后 fork 的 worker 中需要重新启动线程
+            if self._thread is None or self._pid != os.getpid():
+                self._thread = threading.Thread(target=self._run, name='webhook-debouncer', daemon=True)
+                self._pid = os.getpid()
+                self._thread.start()
+            self._cond.notify()
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    due = [(k, v) for k, (deadline, v) in self._pending.items() if deadline <= now]
+                    if due:
+                        for k, _ in due:
+                            del self._pending[k]
+                        break
+                    next_deadline = min((d for d, _ in self._pending.values()), default=None)
+                    self._cond.wait(None if next_deadline is None else next_deadline - now)
+            for k, v in due:
+                try:
+                    self.callback(k, v)
+                except Exception:
+                    app.logger.exception("webhook 预渲染提交失败：%s", k)
+
+
+# (project, task) -> 已处理的最新 updated_at；((project, task), quality) -> 已预渲染的缓存键
+# 按 worker 进程分别记录，条目数有上限；_webhook_lock 保证读改写的原子性
+_webhook_latest = TTLCache(WEBHOOK_TRACKED_TASKS)
+_prerendered = TTLCache(WEBHOOK_TRACKED_TASKS * max(1, len(WEBHOOK_QUALITIES)))
+_webhook_lock = threading.Lock()
+
+
+def _prerender_done(key, token, future):
+    with _job_lock:
+        _job_pending.discard(token)
+    try:
+        cache_key = future.result()
+    except Exception:
+        app.logger.exception("预渲染失败：%s", key)
+        return
+    if cache_key is None:
+        return
+    with _webhook_lock:
+        previous, _ = _prerendered.get(key)
+        _prerendered.set(key, cache_key)
+    # 新版本已渲染，旧版本的 PDF 不会再被 /download 命中，直接删除腾出缓存空间
+    if previous is not None and previous != cache_key:
+        _pdf_cache.delete(previous)
+
+
+def _submit_prerender(key, updated_at):
+    project_id, task_id = key
+    with _webhook_lock:
+        # 防抖期间又收到了更新的事件（已另行排期），本次不再渲染
+        if _webhook_latest.get(key)[0] != updated_at:
+            return
+    for quality in WEBHOOK_QUALITIES:
+        token = object()
+        with _job_lock:
+            if len(_job_pending) >= WEBHOOK_MAX_PENDING:
+                # 进程池繁忙：不预渲染，之后的 /download 按需渲染
+                PRERENDER_DROPPED_TOTAL.inc()
+                continue
+            _job_pending.add(token)
+        try:
+            future = submit_to_job_pool(prerender_task, project_id, task_id, quality)
+        except Exception:
+            with _job_lock:
+                _job_pending.discard(token)
+            raise
+        future.add_done_callback(lambda f, k=(key, quality), t=token: _prerender_done(k, t, f))
+
+
+_webhook_debouncer = Debouncer(WEBHOOK_DEBOUNCE_SECONDS, _submit_prerender)
+
+
+def webhook_tasks(payload: dict) -> list:
+    """
+    从 Label Studio webhook 事件中取出 [(project_id, task_id, updated_at)]。
+    ANNOTATION_CREATED / ANNOTATION_UPDATED 带完整 task；ANNOTATIONS_DELETED 只有 annotations 列表。
+    """
+    project = payload.get('project') or {}
+    project_id = project.get('id') if isinstance(project, dict) else project
+    task = payload.get('task')
+    if isinstance(task, dict) and task.get('id') is not None:
+        return [(task.get('project', project_id), task['id'], task.get('updated_at'))]
+    tasks = {}
+    for ann in payload.get('annotations') or []:
+        task_id = ann.get('task') if isinstance(ann, dict) else None
+        if task_id is not None and project_id is not None:
+            tasks[task_id] = (project_id, task_id, ann.get('updated_at'))
+    return list(tasks.values())
+
+# -------------------------------
+# 启动预热
+# -------------------------------
+
+# 各启动阶段耗时（秒）：import 为模块加载，warm_up 为预热渲染
+STARTUP_SECONDS = {}
+
+_WARM_UP_TASK = {
+    'id': 0,
+    'annotations': [{'result': [
+        {'id': 'w1', 'type': 'rectangle', 'value': {'x': 10, 'y': 10, 'width': 40, 'height': 20, 'rotation': 0}},
+        {'id': 'w1', 'type': 'labels', 'value': {'labels': ['Length']}},
+        {'id': 'w1', 'type': 'textarea', 'value': {'text': ["12' 6 1/2\""]}},
+        {'id': 'w2', 'type': 'rectangle', 'value': {'x': 10, 'y': 50, 'width': 40, 'height': 0.5, 'rotation': 30}},
+        {'id': 'w2', 'type': 'labels', 'value': {'labels': ['Bearing']}},
+        {'id': 'w2', 'type': 'textarea', 'value': {'text': ['45 30 15']}},
+        {'type': 'relation', 'from_id': 'w1', 'to_id': 'w2', 'labels': []},
+    ]}],
+}
+
+
+def warm_up() -> float:
+    """
+    在内存中渲染一张极小的 PDF（不访问 Label Studio），把字体解析、PIL 插件与 reportlab 各模块的
+    首次开销提前付掉，返回耗时（秒）。gunicorn 预加载时在 master 中调用一次，worker fork 后直接继承。
+    """
+    start = time.perf_counter()
+    ensure_fonts()
+    image_buffer = BytesIO()
+    Image.new('RGB', (64, 48), (255, 255, 255)).save(image_buffer, format='JPEG')
+    for data in (image_buffer.getvalue(), Image.new('RGB', (64, 48))):
+        # 一次走 JPEG 直通，一次走解码/编码路径
+        annotate_image_to_pdf(data, load_annotations(_WARM_UP_TASK), BytesIO(), {}, 'warm-up', 32)
+    STARTUP_SECONDS['warm_up'] = time.perf_counter() - start
+    return STARTUP_SECONDS['warm_up']
+
+# -------------------------------
+# 路由
+# -------------------------------
+
+def send_stream(fileobj, download_name: str, mimetype: str):
+    """
+    把 spool_file() 作为附件分块发送（带 Content-Length），发送完毕后关闭，落盘的临时文件随之删除。
+    """
+    size = fileobj.seek(0, os.SEEK_END)
+    fileobj.seek(0)
+    resp = send_file(fileobj, as_attachment=True, download_name=download_name, mimetype=mimetype)
+    resp.content_length = size
+    return resp
+
+@app.before_request
+def start_request_timing():
+    g.request_start = time.perf_counter()
+    g.timings = StageTimings()
+    g.timings_token = _current_timings.set(g.timings)
+    if DEBUG_PROFILE and request.args.get('profile') == '1':
+        import cProfile
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+@app.after_request
+def finish_request_timing(response):
+    """
+    写入 Server-Timing 头并计入 /metrics；?profile=1 时用 cProfile 报告替换响应体。
+    """
+    if 'request_start' not in g:
+        return response
+    total = time.perf_counter() - g.request_start
+    endpoint = request.endpoint or 'unknown'
+    REQUEST_SECONDS.observe(total, endpoint)
+    REQUESTS_TOTAL.inc(endpoint, str(response.status_code))
+    response.headers['Server-Timing'] = g.timings.server_timing(total)
+
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        import pstats
+        profiler.disable()
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(60)
+        profiled = Response(out.getvalue(), mimetype='text/plain')
+        profiled.headers['Server-Timing'] = response.headers['Server-Timing']
+        profiled.headers['X-Profiled-Status'] = str(response.status_code)
+        response.close()
+        return profiled
+    return response
+
+@app.teardown_request
+def reset_request_timing(exc=None):
+    token = g.pop('timings_token', None)
+    if token is not None:
+        _current_timings.reset(token)
+
+@app.errorhandler(requests.exceptions.RequestException)
+def handle_upstream_error(e):
+    """
+    上游 Label Studio 出错（超时、连接失败、非 2xx）时返回 JSON，而不是 500 页面。
+    """
+    if isinstance(e, requests.exceptions.Timeout):
+        return jsonify({"error": f"Label Studio 请求超时：{e}"}), 504
+    status = getattr(e.response, 'status_code', None)
+    return jsonify({"error": f"Label Studio 请求失败：{e}", "upstream_status": status}), 502
+
+@app.errorhandler(ImageTooLargeError)
+def handle_image_too_large(e):
+    return jsonify({"error": str(e)}), 413
+
+@app.errorhandler(RenderRejectedError)
+def handle_render_rejected(e):
+    resp = jsonify({"error": str(e)})
+    resp.status_code = 429
+    resp.headers['Retry-After'] = str(e.retry_after)
+    return resp
 
 @app.route('/')
 def index():
     return jsonify({"message": "Welcome to Xu's Label Studio PDF Exportor 🚅"})
 
+def fetch_for_download(project_id, task_id):
+    """项目与任务互不依赖：项目（多数情况命中缓存）放到拉取线程池，任务在当前线程，同时进行。"""
+    project_future = ls_submit(get_project_meta, project_id)
+    td = fetch_task(task_id)
+    return project_future.result(), td
+
+
+_fetch_flight = SingleFlight('fetch')
+
 @app.route('/download')
 def download():
+    """
+    单个任务：?project=<id>&task=<id>&quality=preview|standard|full
+    &layout=tiled 时按原始分辨率分块输出多页 PDF（见 annotate_image_to_tiled_pdf），忽略 quality；
+    原图超过 max_decode_pixels 时返回 413。
+    &annotations=all 或 &annotations=<标注 ID>,<标注 ID> 时每份标注一页（对比不同标注者），图像只解码一次。
+    """
     project_id = request.args.get('project'); task_id = request.args.get('task')
     if not project_id or not task_id:
         return jsonify({"error": "请通过 ?project=<id>&task=<id> 指定参数"}), 400
-    headers = {'Authorization': f"Token {LABEL_STUDIO_TOKEN}"}
-    proj = requests.get(f"{LABEL_STUDIO_HOST}/api/projects/{project_id}", headers=headers)
-    proj.raise_for_status(); pd = proj.json(); title = pd.get('title', f'project_{project_id}')
-    task = requests.get(f"{LABEL_STUDIO_HOST}/api/tasks/{task_id}", headers=headers)
-    task.raise_for_status(); td = task.json()
-    # 时间转换
-    updated = td.get('updated_at')
+    layout = request.args.get('layout', 'page').lower()
+    if layout not in ('page', 'tiled'):
+        return jsonify({"error": "layout 仅支持 page 或 tiled"}), 400
     try:
-        dt = parser.isoparse(updated);
-        if dt.tzinfo is None: dt = dt.replace(tzinfo=tz.tzutc())
-        ts = dt.astimezone(SYDNEY_TZ).strftime('%Y-%m-%d %H:%M:%S')
-    except Exception:
-        ts = updated
-    pdf_title = f"{title}(unit-converted) / Task ID: {task_id} / Last Modified (Sydney Time): {ts}"
+        quality, max_dimension = get_quality_arg()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    selector = request.args.get('annotations')
+    if selector is not None:
+        selector = selector.strip().lower()
+        if selector != 'all':
+            selector = tuple(i.strip() for i in selector.split(',') if i.strip())
+            if not selector or not all(i.isdigit() for i in selector):
+                return jsonify({"error": "annotations 须为 all 或逗号分隔的标注 ID"}), 400
+        if layout == 'tiled':
+            return jsonify({"error": "layout=tiled 不支持 annotations 参数"}), 400
+    # 同一任务的并发下载共用一次拉取（渲染的合并见 render_task_cached）
+    (meta, td), _ = _fetch_flight.do((str(project_id), str(task_id)), fetch_for_download, project_id, task_id)
+    title = meta.title
+    updated = td.get('updated_at')
     fname = f"{title}(unit-converted).pdf"
     ocr = td.get('data',{}).get('ocr')
     if not ocr:
         return jsonify({"error": "Task JSON 中未找到 data['ocr']"}), 500
-    img = requests.get(f"{LABEL_STUDIO_HOST}{ocr}", headers=headers)
-    img.raise_for_status(); image = Image.open(BytesIO(img.content)).convert('RGB')
-    annotations, relations = load_annotations(td)
-    color_map = {lbl: attrs.get('background', '#00ff00')
-                 for lbl, attrs in pd.get('parsed_label_config', {}).get('label', {}).get('labels_attrs', {}).items()}
-    buf = BytesIO()
-    annotate_image_to_pdf(image, annotations, relations, buf, color_map, pdf_title)
-    buf.seek(0)
-    return send_file(buf, as_attachment=True, download_name=fname, mimetype='application/pdf')
+    if selector is not None:
+        try:
+            select_annotations(td, selector)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 404
+
+    # 同一任务未修改时直接复用已渲染的 PDF；浏览器带 ETag / If-Modified-Since 时可得到 304
+    cache_key = pdf_cache_key(project_id, task_id, updated, meta, layout_cache_tag(quality, layout, selector))
+    etag, last_modified = pdf_etag(cache_key), parse_http_time(updated)
+    if (request.if_none_match.contains(etag) or
+            (not request.if_none_match and last_modified and request.if_modified_since
+             and last_modified <= request.if_modified_since)):
+        resp = app.response_class(status=304)
+        resp.set_etag(etag)
+        if last_modified: resp.last_modified = last_modified
+        return resp
+    _, source = render_task_cached(project_id, td, meta, quality, max_dimension, layout, selector)
+    if not isinstance(source, str):
+        return send_stream(source, fname, 'application/pdf')
+    return send_file(source, as_attachment=True, download_name=fname, mimetype='application/pdf',
+                     etag=etag, last_modified=last_modified, conditional=True)
+
+@app.route('/download_project', methods=['GET', 'POST'])
+def download_project():
+    """
+    整个项目批量导出：?project=<id>&format=pdf|zip&quality=preview|standard|full，格式见 export_tasks。
+    任务 JSON 与图像通过有界线程池并发拉取，总耗时接近最慢的一次拉取而非所有拉取之和。
+    增量导出：POST 上次 ZIP 中的 manifest.json 作为请求体，加 &delta=1 时只打包有变化的任务（见 export_zip）。
+    大项目反复导出请用 delta=1：不带 delta 的重新导出只能靠有界的 PDF 缓存（pdf_cache_max_bytes）复用，
+    项目的 PDF 总量超过缓存上限时，顺序导出会把自己先写入的条目淘汰掉，几乎全部重新渲染。
+    单个任务失败不中断导出，其 ID 见 X-Failed-Tasks 响应头（zip 的 manifest.json 中 failed 附错误信息）。
+    """
+    project_id = request.args.get('project')
+    out_format = request.args.get('format', 'pdf').lower()
+    if not project_id:
+        return jsonify({"error": "请通过 ?project=<id> 指定参数"}), 400
+    if out_format not in ('pdf', 'zip'):
+        return jsonify({"error": "format 仅支持 pdf 或 zip"}), 400
+    try:
+        quality, _ = get_quality_arg()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    previous = request.get_json(silent=True) if request.method == 'POST' else None
+    if request.method == 'POST' and (out_format != 'zip' or not isinstance(previous, dict)):
+        return jsonify({"error": "增量导出须使用 format=zip，请求体为上次导出的 manifest.json"}), 400
+
+    # 项目配置与任务列表互不依赖，并行拉取
+    project_future = ls_submit(get_project_meta, project_id)
+    task_ids = list_project_tasks(project_id)
+    meta = project_future.result()
+    if not task_ids:
+        return jsonify({"error": "项目中没有任务"}), 404
+
+    output = spool_file()
+    skipped, failed, manifest = export_tasks(project_id, meta, task_ids, out_format, output, quality,
+                                             previous=previous, delta=request.args.get('delta') == '1')
+    fname = f"{meta.title}(unit-converted).{out_format}"
+    mimetype = 'application/pdf' if out_format == 'pdf' else 'application/zip'
+
+    if len(skipped) == len(task_ids):
+        output.close()
+        return jsonify({"error": "项目中所有任务均缺少 data['ocr']"}), 500
+    if manifest is not None and manifest['delta']:
+        fname = f"{meta.title}(unit-converted)-delta.zip"
+    resp = send_stream(output, fname, mimetype)
+    if skipped:
+        resp.headers['X-Skipped-Tasks'] = ','.join(str(t) for t in skipped)
+    if failed:
+        resp.headers['X-Failed-Tasks'] = ','.join(str(t['id']) for t in failed)
+    return resp
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    """
+    提交异步导出，请求体为 JSON：
+      {"project": 1, "task": 5}                      单个任务，结果与 /download 相同
+      {"project": 1, "tasks": [5, 6], "format": "zip"}  指定任务
+      {"project": 1, "format": "pdf"}                整个项目
+    可选 "quality"；zip 格式还可带上次导出的 "manifest" 与 "delta": true，只打包有变化的任务（见 export_zip）。
+    立即返回 202 与 job id，之后轮询 GET /jobs/<id>，完成后从 /jobs/<id>/result 下载。
+    """
+    sweep_jobs()
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not body.get('project'):
+        return jsonify({"error": "请求体须为 JSON 对象，并包含 project"}), 400
+    project_id = body['project']
+    out_format = str(body.get('format', 'pdf')).lower()
+    quality = str(body.get('quality', DEFAULT_QUALITY)).lower()
+    if out_format not in ('pdf', 'zip'):
+        return jsonify({"error": "format 仅支持 pdf 或 zip"}), 400
+    if quality not in QUALITY_PROFILES:
+        return jsonify({"error": f"quality 仅支持 {'、'.join(QUALITY_PROFILES)}"}), 400
+    if body.get('task') is not None:
+        task_ids = [body['task']]
+    elif body.get('tasks') is not None:
+        task_ids = body['tasks']
+        if not isinstance(task_ids, list) or not task_ids:
+            return jsonify({"error": "tasks 须为非空数组"}), 400
+    else:
+        task_ids = None
+
+    previous = body.get('manifest')
+    if previous is not None and not isinstance(previous, dict):
+        return jsonify({"error": "manifest 须为上次导出 ZIP 中的 manifest.json 对象"}), 400
+    job_id = submit_export_job(project_id, task_ids, out_format, quality, previous, bool(body.get('delta')))
+    if job_id is None:
+        resp = jsonify({"error": f"排队任务已达上限（{JOB_MAX_PENDING}），请稍后重试"})
+        resp.status_code = 429
+        resp.headers['Retry-After'] = '30'
+        return resp
+    resp = jsonify({"id": job_id, "status_url": f"/jobs/{job_id}", "result_url": f"/jobs/{job_id}/result"})
+    resp.status_code = 202
+    resp.headers['Location'] = f"/jobs/{job_id}"
+    return resp
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    sweep_jobs()
+    status = read_job_status(job_id)
+    if status is None:
+        return jsonify({"error": "任务不存在或已过期"}), 404
+    return jsonify(status)
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    status = read_job_status(job_id)
+    if status is None:
+        return jsonify({"error": "任务不存在或已过期"}), 404
+    if status.get('state') != 'done':
+        return jsonify({"error": "任务尚未完成", **status}), 409
+    resp = send_file(os.path.join(job_dir(job_id), 'result'), as_attachment=True,
+                     download_name=status['filename'], mimetype=status['mimetype'], conditional=True)
+    if status.get('skipped'):
+        resp.headers['X-Skipped-Tasks'] = ','.join(str(t) for t in status['skipped'])
+    if status.get('failed'):
+        resp.headers['X-Failed-Tasks'] = ','.join(str(t['id']) for t in status['failed'])
+    return resp
+
+@app.route('/webhook', methods=['POST'])
+def webhook():
+    """
+    接收 Label Studio 的标注事件（ANNOTATION_CREATED / ANNOTATION_UPDATED / ANNOTATIONS_DELETED），
+    按任务防抖后在后台预渲染，之后的 /download 直接命中 PDF 缓存。
+    """
+    if WEBHOOK_TOKEN and request.headers.get('Authorization') != WEBHOOK_TOKEN:
+        return jsonify({"error": "Authorization 不正确"}), 401
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify({"error": "请求体须为 JSON 对象"}), 400
+    action = payload.get('action')
+    if not isinstance(action, str) or not action.startswith('ANNOTATION'):
+        return jsonify({"scheduled": [], "ignored": action})
+
+    scheduled, stale = [], []
+    for project_id, task_id, updated_at in webhook_tasks(payload):
+        key = (str(project_id), str(task_id))
+        event_time = parse_http_time(updated_at)
+        with _webhook_lock:
+            previous, _ = _webhook_latest.get(key)
+            previous_time = parse_http_time(previous) if previous else None
+            # 事件可能乱序到达：比已处理的版本旧的直接丢弃
+            if event_time and previous_time and event_time < previous_time:
+                stale.append(task_id)
+                continue
+            _webhook_latest.set(key, updated_at)
+            outdated = []
+            if updated_at != previous:
+                for quality in WEBHOOK_QUALITIES:
+                    cache_key, _ = _prerendered.get((key, quality))
+                    if cache_key is not None:
+                        _prerendered.pop((key, quality))
+                        outdated.append(cache_key)
+        # 任务已有新版本，之前预渲染的 PDF 不会再被命中
+        for cache_key in outdated:
+            _pdf_cache.delete(cache_key)
+        _webhook_debouncer.schedule(key, updated_at)
+        scheduled.append(task_id)
+    return jsonify({"scheduled": scheduled, "stale": stale})
+
+@app.route('/convert', methods=['POST'])
+def convert():
+    """
+    批量单位换算，请求体为 JSON 数组：
+      [{"type": "length", "text": "155' 5 1/4\""}, {"type": "bearing", "text": "45 30 15"}, ...]
+    按顺序返回 {"results": [{"type", "text", "ok", ...换算字段}]}，无法解析的条目 ok 为 false。
+    """
+    items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        return jsonify({"error": "请求体须为 JSON 数组：[{\"type\": \"length|bearing\", \"text\": \"...\"}]"}), 400
+    if len(items) > CONVERT_MAX_ITEMS:
+        return jsonify({"error": f"单次最多换算 {CONVERT_MAX_ITEMS} 条"}), 413
+    results = []
+    for i, item in enumerate(items):
+        kind = item.get('type') if isinstance(item, dict) else None
+        text = item.get('text') if isinstance(item, dict) else None
+        if kind not in ('length', 'bearing') or not isinstance(text, str):
+            return jsonify({"error": f"第 {i} 条格式错误：需要 type 为 length 或 bearing，text 为字符串"}), 400
+        if kind == 'length':
+            converted = convert_length_text(text)
+            ok = isinstance(converted, dict)
+            fields = converted if ok else {}
+        else:
+            fields = convert_bearing_text(text)
+            ok = fields['deg_text'] != ''
+        results.append({"type": kind, "text": text, "ok": ok, **fields})
+    return jsonify({"results": results})
+
+@app.route('/cache/invalidate', methods=['POST'])
+def invalidate_cache():
+    """
+    清除项目元数据缓存：?project=<id> 只清除该项目，不带参数则全部清除。
+    修改 Label Studio 的标签配置后调用，使颜色立即生效：本进程直接清除，
+    其他 worker 与后台渲染进程通过 CACHE_DIR 下的失效标记在下次取元数据时重新拉取。
+    返回值 invalidated 为本进程清除的条目数。
+    """
+    project_id = request.args.get('project')
+    if project_id:
+        mark_invalidated(str(project_id))
+        removed = int(_project_cache.pop(str(project_id)))
+    else:
+        mark_invalidated()
+        removed = _project_cache.clear()
+    return jsonify({"invalidated": removed})
+
+@app.route('/metrics')
+def metrics():
+    """
+    Prometheus 文本格式的指标。注意：指标按 gunicorn worker 进程分别累计。
+    """
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for field, kind in (('hits', 'counter'), ('misses', 'counter'), ('evictions', 'counter'),
+                        ('entries', 'gauge'), ('bytes', 'gauge')):
+        name = f"label_to_pdf_cache_{field}" + ('_total' if kind == 'counter' else '')
+        lines.append(f"# TYPE {name} {kind}")
+        for cache_name, cache in (('images', _image_cache), ('pdfs', _pdf_cache)):
+            lines.append(f'{name}{{cache="{cache_name}"}} {cache.stats()[field]}')
+    lines.append("# TYPE label_to_pdf_startup_seconds gauge")
+    for phase, seconds in STARTUP_SECONDS.items():
+        lines.append(f'label_to_pdf_startup_seconds{{phase="{phase}"}} {seconds:.4f}')
+    admission = _admission.stats()
+    for field, name in (('running', 'render_running'), ('queued', 'render_queue_depth'),
+                        ('reserved_bytes', 'render_reserved_bytes')):
+        lines.append(f"# TYPE label_to_pdf_{name} gauge")
+        lines.append(f"label_to_pdf_{name} {admission[field]}")
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+@app.route('/cache/stats')
+def cache_stats():
+    return jsonify({"images": _image_cache.stats(), "pdfs": _pdf_cache.stats()})
+
+STARTUP_SECONDS['import'] = time.perf_counter() - _IMPORT_STARTED
 
 if __name__ == '__main__':
+    warm_up()
     app.run(host='0.0.0.0', port=int(os.getenv('PORT', 5000)), debug=True)
 
 
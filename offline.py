@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+离线批量渲染：读取 Label Studio 的 JSON 导出与本地图像目录，用多进程渲染全部任务为 PDF，
+不经过 HTTP，也不需要 label_studio_api_token。
+
+  python -m offline export.json --images ./images --config label_config.xml --out ./pdfs
+
+--config 可以是标签配置 XML、项目 JSON（GET /api/projects/<id> 的返回，含 parsed_label_config 或 label_config），
+或直接的 {"标签": "#颜色"} 映射。
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+from urllib.parse import unquote, urlparse
+
+import main
+
+# Label Studio 上传文件时在文件名前加的 8 位随机前缀，如 1a2b3c4d-scan.jpg
+_UPLOAD_PREFIX_RE = re.compile(r'^[0-9a-f]{8}-')
+
+# 子进程中的渲染参数，由 init_worker 设置
+_worker = {}
+
+
+def load_label_config(path: str):
+    """返回 (标签 -> 颜色, 项目标题或 None)。"""
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+    if text.lstrip().startswith('<'):
+        return main.color_map_from_label_config(text), None
+    config = json.loads(text)
+    if 'parsed_label_config' in config:
+        return main.build_color_map(config), config.get('title')
+    if isinstance(config.get('label_config'), str):
+        return main.color_map_from_label_config(config['label_config']), config.get('title')
+    return {str(k): str(v) for k, v in config.items()}, None
+
+
+def resolve_image(images_dir: str, ocr: str):
+    """
+    按 data['ocr'] 的文件名在本地目录中找图像：先找原文件名，再找去掉上传前缀的文件名。
+    找不到时返回 None。
+    """
+    name = os.path.basename(unquote(urlparse(ocr).path))
+    for candidate in (name, _UPLOAD_PREFIX_RE.sub('', name)):
+        path = os.path.join(images_dir, candidate)
+        if candidate and os.path.isfile(path):
+            return path
+    return None
+
+
+def init_worker(images_dir, out_dir, color_map, title, max_dimension):
+    _worker.update(images_dir=images_dir, out_dir=out_dir, palette=main.get_style_palette(color_map),
+                   title=title, max_dimension=max_dimension)
+
+
+def render_one(td: dict):
+    """
+    渲染一个任务，返回 (task_id, 状态, 输出字节数或错误信息)，状态为 ok / skipped / failed。
+    """
+    task_id = td.get('id')
+    try:
+        ocr = td.get('data', {}).get('ocr')
+        if not ocr:
+            return task_id, 'skipped', "缺少 data['ocr']"
+        image_path = resolve_image(_worker['images_dir'], ocr)
+        if image_path is None:
+            return task_id, 'skipped', f"本地找不到图像：{ocr}"
+        with open(image_path, 'rb') as f:
+            data = f.read()
+        out_path = os.path.join(_worker['out_dir'], f"task_{task_id}.pdf")
+        tmp_path = out_path + '.tmp'
+        # 离线渲染只排队不拒绝
+        with open(tmp_path, 'wb') as out, main.admission_timeout(None):
+            main.annotate_image_to_pdf(data, main.load_annotations(td), out, _worker['palette'],
+                                       main.task_pdf_title(_worker['title'], task_id, td.get('updated_at')),
+                                       _worker['max_dimension'])
+        os.replace(tmp_path, out_path)
+        return task_id, 'ok', os.path.getsize(out_path)
+    except Exception as e:
+        return task_id, 'failed', f"{type(e).__name__}: {e}"
+
+
+def main_cli(argv=None):
+    ap = argparse.ArgumentParser(prog='python -m offline', description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('export', help='Label Studio JSON 导出文件（任务数组）')
+    ap.add_argument('--images', required=True, help='本地图像目录')
+    ap.add_argument('--config', required=True, help='标签配置：XML、项目 JSON 或 标签 -> 颜色 映射')
+    ap.add_argument('--out', required=True, help='PDF 输出目录')
+    ap.add_argument('--title', help='PDF 标题中的项目名（默认取配置中的 title，否则为导出文件名）')
+    ap.add_argument('--quality', default=main.DEFAULT_QUALITY, choices=list(main.QUALITY_PROFILES))
+    ap.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help='渲染进程数')
+    args = ap.parse_args(argv)
+
+    with open(args.export, encoding='utf-8') as f:
+        tasks = json.load(f)
+    if not isinstance(tasks, list):
+        ap.error('导出文件须为 JSON 任务数组（Label Studio 的 JSON 导出格式）')
+    color_map, config_title = load_label_config(args.config)
+    title = args.title or config_title or os.path.splitext(os.path.basename(args.export))[0]
+    os.makedirs(args.out, exist_ok=True)
+
+    counts = {'ok': 0, 'skipped': 0, 'failed': 0}
+    total_bytes = 0
+    start = time.perf_counter()
+    init_args = (args.images, args.out, color_map, title, main.QUALITY_PROFILES[args.quality])
+    with multiprocessing.Pool(args.jobs, initializer=init_worker, initargs=init_args) as pool:
+        # 任务数多时按块分发，减少进程间往返
+        chunksize = max(1, len(tasks) // (args.jobs * 8))
+        for i, (task_id, state, detail) in enumerate(pool.imap_unordered(render_one, tasks, chunksize), 1):
+            counts[state] += 1
+            if state == 'ok':
+                total_bytes += detail
+            else:
+                print(f"task {task_id}: {state}：{detail}", file=sys.stderr)
+            if i % 100 == 0:
+                print(f"{i}/{len(tasks)} …", file=sys.stderr)
+    elapsed = time.perf_counter() - start
+
+    print(f"渲染 {counts['ok']} 个，跳过 {counts['skipped']} 个，失败 {counts['failed']} 个，"
+          f"共 {len(tasks)} 个任务，{args.jobs} 个进程")
+    print(f"耗时 {elapsed:.1f}s，{counts['ok'] / elapsed if elapsed else 0:.2f} 任务/s，"
+          f"输出 {total_bytes / 1e6:.1f} MB（{total_bytes / 1e6 / elapsed if elapsed else 0:.2f} MB/s）")
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
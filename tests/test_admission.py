@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import json
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import main
+
+
+def controller(tmp_path, slots=1, budget=100, timeout=0.1):
+    return main.AdmissionController(str(tmp_path / 'admission.json'), slots, budget, timeout)
+
+
+def test_slots_are_shared_between_controllers(tmp_path):
+    # 两个实例共用同一个状态文件，相当于两个 worker 进程
+    first, second = controller(tmp_path), controller(tmp_path)
+    with first.admit(10):
+        assert second.stats()['running'] == 1
+        with pytest.raises(main.RenderRejectedError):
+            with second.admit(10):
+                pass
+    with second.admit(10):
+        pass
+    assert first.stats() == {"running": 0, "queued": 0, "reserved_bytes": 0, "slots": 1, "budget_bytes": 100}
+
+
+def test_memory_budget(tmp_path):
+    first, second = controller(tmp_path, slots=4), controller(tmp_path, slots=4)
+    with first.admit(60):
+        with second.admit(40):
+            assert first.stats()['reserved_bytes'] == 100
+        with pytest.raises(main.RenderRejectedError):
+            with second.admit(41):
+                pass
+
+
+def test_admission_timeout_context_waits(tmp_path):
+    first, second = controller(tmp_path), controller(tmp_path)
+    order = []
+
+    def hold():
+        with first.admit(10):
+            order.append('first')
+            time.sleep(0.3)
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    while not order:
+        time.sleep(0.01)
+    with main.admission_timeout(None):
+        with second.admit(10):
+            order.append('second')
+    thread.join()
+    assert order == ['first', 'second']
+
+
+def test_entries_of_dead_processes_are_dropped(tmp_path):
+    dead = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'],
+                          capture_output=True, text=True, check=True)
+    pid = int(dead.stdout)
+    (tmp_path / 'admission.json').write_text(json.dumps({'running': [['x', pid, 10]], 'queue': [['y', pid, 10]]}))
+    with controller(tmp_path).admit(10):
+        pass
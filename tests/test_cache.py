@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import os
+
+import main
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = main.DiskLRUCache(str(tmp_path), max_bytes=40)
+    for key in '1234':
+        cache.set(key, b'x' * 10)
+    assert cache.get('1') == b'x' * 10
+    assert cache.get('2') == b'x' * 10
+    cache.set('9', b'x' * 10)
+    # 最近最少使用的是 3（1、2 刚被读取，4 在 3 之后写入）
+    assert cache.get('3') is None
+    for key in '1249':
+        assert cache.get(key) == b'x' * 10
+    assert cache.stats()['evictions'] == 1
+
+
+def test_set_does_not_rescan_when_full(tmp_path, monkeypatch):
+    cache = main.DiskLRUCache(str(tmp_path), max_bytes=20)
+    monkeypatch.setattr(cache, '_rescan', lambda: (_ for _ in ()).throw(AssertionError('rescan')))
+    for key in '12345':
+        cache.set(key, b'x' * 10)
+    assert cache.stats()['entries'] == 2
+
+
+def test_rescan_on_startup_and_missing_entries(tmp_path):
+    first = main.DiskLRUCache(str(tmp_path), max_bytes=30)
+    first.set('a', b'x' * 10)
+    first.set('b', b'x' * 10)
+    # 另一个进程（第二个实例）启动时看到已有文件，并淘汰了 a
+    second = main.DiskLRUCache(str(tmp_path), max_bytes=30)
+    assert second.stats()['entries'] == 2
+    second.delete('a')
+    first.set('c', b'x' * 10)
+    first.set('d', b'x' * 10)
+    # first 淘汰 a 时发现文件已不存在，合并磁盘状态后仍按预算淘汰到 b
+    assert first.stats()['bytes'] <= 30
+    assert first.get('c') == b'x' * 10 and first.get('d') == b'x' * 10
+
+
+def test_budget_is_shared_between_instances(tmp_path):
+    # 两个实例相当于共享同一目录的两个进程，各自写入不同的 key
+    first = main.DiskLRUCache(str(tmp_path), max_bytes=30)
+    second = main.DiskLRUCache(str(tmp_path), max_bytes=30)
+    for i in range(6):
+        first.set(f"first-{i}", b'x' * 10)
+        second.set(f"second-{i}", b'x' * 10)
+    on_disk = sum(e.stat().st_size for e in os.scandir(tmp_path) if not e.name.startswith('.'))
+    assert on_disk <= 30
+    assert first.stats()['bytes'] == second.stats()['bytes'] == on_disk
+    # 最近写入的条目保留下来
+    assert second.get('second-5') == b'x' * 10
+    assert first.get('first-5') == b'x' * 10
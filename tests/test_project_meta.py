@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import main
+
+
+class FakeResponse:
+    status_code = 200
+    headers = {'ETag': '"p1"'}
+
+    def __init__(self, color):
+        self.color = color
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return {'title': 'Demo', 'parsed_label_config': {'label': {'labels_attrs': {
+            'Length': {'background': self.color}}}}}
+
+
+def test_invalidation_from_another_process(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'INVALIDATION_DIR', str(tmp_path))
+    monkeypatch.setattr(main, '_project_cache', main.TTLCache(8))
+    color = ['#ff0000']
+    calls = []
+
+    def fake_get(path, headers=None, **kwargs):
+        calls.append(headers)
+        return FakeResponse(color[0])
+
+    monkeypatch.setattr(main, 'ls_get', fake_get)
+    first = main.get_project_meta(1)
+    assert main.get_project_meta(1) is first and len(calls) == 1
+
+    # 其他进程处理了 /invalidate_cache：本进程的缓存条目未过期也要重新拉取，且不带条件请求头
+    color[0] = '#00ff00'
+    main.mark_invalidated('1')
+    second = main.get_project_meta(1)
+    assert len(calls) == 2 and not calls[1]
+    assert second.style_hash != first.style_hash
+    assert main.get_project_meta(1) is second and len(calls) == 2
+
+    main.mark_invalidated()
+    main.get_project_meta(1)
+    assert len(calls) == 3
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import threading
+
+import pytest
+
+import main
+
+
+def test_concurrent_calls_share_one_execution():
+    flight = main.SingleFlight('test-shared')
+    started, release = threading.Event(), threading.Event()
+    calls, results = [], []
+
+    def work():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'value'
+
+    leader = threading.Thread(target=lambda: results.append(flight.do('k', work)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(flight.do('k', work))) for _ in range(4)]
+    for t in followers:
+        t.start()
+    # 追随者在开始等待前计入 COALESCED_TOTAL，全部计入后再放行
+    while main.COALESCED_TOTAL._values.get(('test-shared',), 0) < 4:
+        threading.Event().wait(0.01)
+    release.set()
+    for t in [leader] + followers:
+        t.join()
+    assert len(calls) == 1
+    assert sorted(results) == [('value', False)] + [('value', True)] * 4
+
+
+def test_exception_is_shared_and_key_is_released():
+    flight = main.SingleFlight('test')
+
+    def fail():
+        raise ValueError('boom')
+
+    with pytest.raises(ValueError):
+        flight.do('k', fail)
+    # 调用结束即移除，下一次调用重新执行
+    assert flight.do('k', lambda: 1) == (1, False)